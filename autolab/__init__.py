@@ -27,15 +27,21 @@ _stats.startup()
 
 # infos
 from .core.infos import list_devices, list_drivers, infos, config_help, statistics
+from .core.drivers import reload_driver
 
 # Devices
-from .core.devices import get_device
+from .core.devices import get_device, get_devices, read_many
 
 # Webbrowser shortcuts
 from .core.web import community, doc
 
 # Server
-from .core.server import Server as server
+def server(port=None):
+
+    ''' Starts an autolab server, to control the local devices from another computer '''
+
+    from .core.server import Server
+    return Server(port)
 
 # GUI
 from .core.gui import start as gui
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Encoding of the messages exchanged between autolab servers and clients
+"""
+
+import pickle
+import struct
+
+
+# Types of the elements values that can be transmitted (no code is executed at decoding)
+TYPES = ['int','float','bool','str','bytes','ndarray','DataFrame']
+
+# Buffers at least this large are sent without copy, after the description of the message
+OUT_OF_BAND_SIZE = 1024
+
+INT = struct.Struct('!q')
+FLOAT = struct.Struct('!d')
+LENGTH = struct.Struct('!I')
+SIZE = struct.Struct('!Q')
+
+
+
+def get_type(name):
+
+    ''' Returns the python type associated to one of the names of TYPES '''
+
+    import numpy as np
+    import pandas as pd
+
+    assert name in TYPES, f"Type {name} not allowed"
+    return {'int':int,'float':float,'bool':bool,'str':str,'bytes':bytes,
+            'ndarray':np.ndarray,'DataFrame':pd.DataFrame}[name]
+
+
+
+def padding(size):
+
+    ''' Number of bytes to add to size to align it on 8 bytes '''
+
+    return -size % 8
+
+
+
+
+
+class PickleCodec :
+
+    ''' Encodes the messages with pickle: any python object, but only safe between trusted hosts '''
+
+    name = 'pickle'
+    msg_type = 1
+
+    def encode(self, obj):
+
+        return [pickle.dumps(obj,protocol=pickle.HIGHEST_PROTOCOL)]
+
+
+    def decode(self, payload):
+
+        return pickle.loads(payload)
+
+
+
+
+
+class BinaryCodec :
+
+    ''' Encodes the messages in a compact binary format, in the style of msgpack: scalars,
+    strings, lists, tuples, dicts, and the types of the elements values (numpy arrays,
+    pandas DataFrames, types). The data of the arrays and of the large bytes is not copied:
+    it is sent as separate buffers after the description of the message, and read back as
+    views of the received payload.
+
+    Payload: number of buffers, size of each buffer, size of the description, description,
+    buffers (each aligned on 8 bytes) '''
+
+    name = 'autolab1'
+    msg_type = 2
+
+    def encode(self, obj):
+
+        ''' Returns the list of the parts of the payload (bytes-like objects) '''
+
+        meta = bytearray()
+        buffers = []
+        self._encode(obj,meta,buffers)
+
+        head = bytearray(LENGTH.pack(len(buffers)))
+        for buffer in buffers : head += SIZE.pack(buffer.nbytes)
+        head += SIZE.pack(len(meta))
+        meta += bytes(padding(len(head)+len(meta)))
+
+        parts = [head+meta]
+        for buffer in buffers :
+            parts.append(buffer)
+            if padding(buffer.nbytes) : parts.append(bytes(padding(buffer.nbytes)))
+        return parts
+
+
+    def _encode(self, obj, meta, buffers):
+
+        import numpy as np
+        import pandas as pd
+
+        if obj is None or obj is pd.NA : meta += b'N' # Missing value of the pandas extension arrays
+        elif obj is True : meta += b'T'
+        elif obj is False : meta += b'F'
+        elif isinstance(obj,np.generic) and not isinstance(obj,(np.ndarray,np.void)) :
+            self._encode(obj.item(),meta,buffers) # numpy scalar
+        elif isinstance(obj,int) :
+            if -2**63 <= obj < 2**63 : meta += b'i' + INT.pack(obj)
+            else : self._encode_str(b'I',str(obj),meta)
+        elif isinstance(obj,float) : meta += b'd' + FLOAT.pack(obj)
+        elif isinstance(obj,complex) : meta += b'c' + FLOAT.pack(obj.real) + FLOAT.pack(obj.imag)
+        elif isinstance(obj,str) : self._encode_str(b's',obj,meta)
+        elif isinstance(obj,(bytes,bytearray)) :
+            if len(obj) < OUT_OF_BAND_SIZE : meta += b'B' + LENGTH.pack(len(obj)) + obj
+            else :
+                meta += b'b' + LENGTH.pack(len(buffers))
+                buffers.append(memoryview(obj))
+        elif isinstance(obj,(list,tuple)) :
+            meta += (b'l' if isinstance(obj,list) else b't') + LENGTH.pack(len(obj))
+            for item in obj : self._encode(item,meta,buffers)
+        elif isinstance(obj,dict) :
+            meta += b'm' + LENGTH.pack(len(obj))
+            for key,value in obj.items() :
+                self._encode(key,meta,buffers)
+                self._encode(value,meta,buffers)
+        elif isinstance(obj,np.ndarray) :
+            if obj.dtype.hasobject : # Python objects: encoded one by one
+                meta += b'o'
+                self._encode(list(obj.shape),meta,buffers)
+                self._encode(obj.ravel().tolist(),meta,buffers)
+            else :
+                shape = list(obj.shape) # ascontiguousarray returns at least 1 dimension
+                obj = np.ascontiguousarray(obj) # No copy if already contiguous
+                meta += b'a'
+                self._encode_str(b's',obj.dtype.str,meta) # Includes the byte order
+                self._encode(shape,meta,buffers)
+                meta += LENGTH.pack(len(buffers))
+                if obj.dtype.kind in 'Mm' : obj = obj.view('i8') # Dates and durations: no buffer interface
+                buffers.append(memoryview(obj).cast('B'))
+        elif isinstance(obj,pd.DataFrame) :
+            meta += b'p'
+            # np.asarray converts the pandas extension arrays (strings, categories...) to numpy
+            columns = [np.asarray(obj.iloc[:,k]) for k in range(obj.shape[1])]
+            self._encode([list(obj.columns),np.asarray(obj.index),columns],meta,buffers)
+        elif isinstance(obj,type) :
+            name = {np.ndarray:'ndarray',pd.DataFrame:'DataFrame'}.get(obj,obj.__name__)
+            assert name in TYPES, f"Type {name} cannot be encoded"
+            self._encode_str(b'y',name,meta)
+        else :
+            raise TypeError(f"Object of type {type(obj).__name__} cannot be encoded")
+
+
+    def _encode_str(self, tag, text, meta):
+
+        data = text.encode()
+        meta += tag + LENGTH.pack(len(data)) + data
+
+
+    def decode(self, payload):
+
+        ''' Decodes a payload (bytearray): the arrays are views of it '''
+
+        view = memoryview(payload)
+        nbuffers, = LENGTH.unpack_from(view,0)
+        offset = LENGTH.size
+        sizes = [SIZE.unpack_from(view,offset+SIZE.size*k)[0] for k in range(nbuffers)]
+        offset += SIZE.size*nbuffers
+        meta_size, = SIZE.unpack_from(view,offset)
+        meta_start = offset+SIZE.size
+
+        buffers = []
+        offset = meta_start + meta_size
+        offset += padding(offset)
+        for size in sizes :
+            buffers.append(view[offset:offset+size])
+            offset += size + padding(size)
+
+        obj, end = self._decode(view,meta_start,buffers)
+        assert end == meta_start+meta_size, 'Invalid message'
+        return obj
+
+
+    def _decode(self, view, offset, buffers):
+
+        import numpy as np
+        import pandas as pd
+
+        tag = bytes(view[offset:offset+1])
+        offset += 1
+
+        if tag == b'N' : return None, offset
+        if tag == b'T' : return True, offset
+        if tag == b'F' : return False, offset
+        if tag == b'i' : return INT.unpack_from(view,offset)[0], offset+INT.size
+        if tag == b'd' : return FLOAT.unpack_from(view,offset)[0], offset+FLOAT.size
+        if tag == b'c' :
+            real, = FLOAT.unpack_from(view,offset)
+            imag, = FLOAT.unpack_from(view,offset+FLOAT.size)
+            return complex(real,imag), offset+2*FLOAT.size
+        if tag in [b's',b'I',b'y',b'B'] :
+            length, = LENGTH.unpack_from(view,offset)
+            offset += LENGTH.size
+            data = bytes(view[offset:offset+length])
+            offset += length
+            if tag == b'B' : return data, offset
+            text = data.decode()
+            if tag == b'I' : return int(text), offset
+            if tag == b'y' : return get_type(text), offset
+            return text, offset
+        if tag == b'b' :
+            index, = LENGTH.unpack_from(view,offset)
+            return bytes(buffers[index]), offset+LENGTH.size
+        if tag in [b'l',b't'] :
+            length, = LENGTH.unpack_from(view,offset)
+            offset += LENGTH.size
+            items = []
+            for k in range(length) :
+                item, offset = self._decode(view,offset,buffers)
+                items.append(item)
+            return (items if tag == b'l' else tuple(items)), offset
+        if tag == b'm' :
+            length, = LENGTH.unpack_from(view,offset)
+            offset += LENGTH.size
+            obj = {}
+            for k in range(length) :
+                key, offset = self._decode(view,offset,buffers)
+                obj[key], offset = self._decode(view,offset,buffers)
+            return obj, offset
+        if tag == b'a' :
+            dtype, offset = self._decode(view,offset,buffers)
+            shape, offset = self._decode(view,offset,buffers)
+            index, = LENGTH.unpack_from(view,offset)
+            array = np.frombuffer(buffers[index],dtype=np.dtype(dtype)).reshape(shape)
+            return array, offset+LENGTH.size
+        if tag == b'o' :
+            shape, offset = self._decode(view,offset,buffers)
+            items, offset = self._decode(view,offset,buffers)
+            array = np.empty(len(items),dtype=object)
+            array[:] = items
+            return array.reshape(shape), offset
+        if tag == b'p' :
+            (columns,index,values), offset = self._decode(view,offset,buffers)
+            return pd.DataFrame(dict(zip(columns,values)),index=index,columns=columns), offset
+        raise ValueError(f'Invalid tag {tag} in message')
+
+
+
+
+
+# Available codecs, by order of preference
+CODECS = {codec.name:codec for codec in [BinaryCodec(),PickleCodec()]}
@@ -93,6 +93,7 @@ def check_autolab_config():
     """ This function checks config file structures """
 
     autolab_config = load_config('autolab')
+    initial_config = {section:dict(autolab_config[section]) for section in autolab_config.sections()}
 
     # Check stats configuration
     if 'stats' not in autolab_config.sections() or 'enabled' not in autolab_config['stats'].keys() :
@@ -112,8 +113,9 @@ def check_autolab_config():
     if 'port' not in autolab_config['server'].keys() :
         autolab_config['server']['port'] = 4001
 
-
-    save_config('autolab',autolab_config)
+    # Only rewrite the file if something has been added
+    if initial_config != {section:dict(autolab_config[section]) for section in autolab_config.sections()} :
+        save_config('autolab',autolab_config)
 
 
 def get_stats_config():
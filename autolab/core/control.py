@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Control of a running scan (pause, resume, stop) shared between threads
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ScanControl :
+
+    ''' Control channel of a scan thread. Pause, resume and stop requests are
+    signalled through threading events, so that the scan thread reacts as
+    soon as they are made. It also provides an interruptible sleep for the
+    Wait steps, and timing hooks called at the start and at the end of each
+    step of the scan '''
+
+    def __init__(self):
+
+        self._stop_event = threading.Event()
+        self._run_event = threading.Event() # Cleared while the scan is paused
+        self._run_event.set()
+        self._hooks = []
+
+
+
+    # Requests
+    # =========================================================================
+
+    def stop(self):
+
+        ''' Request the scan to stop (also releases a paused scan) '''
+
+        self._stop_event.set()
+        self._run_event.set()
+
+
+    def pause(self):
+
+        ''' Request the scan to pause '''
+
+        if self.is_stopped() is False :
+            self._run_event.clear()
+
+
+    def resume(self):
+
+        ''' Request the scan to resume '''
+
+        self._run_event.set()
+
+
+
+    # State
+    # =========================================================================
+
+    def is_stopped(self):
+
+        ''' Returns True if the scan has been stopped '''
+
+        return self._stop_event.is_set()
+
+
+    def is_paused(self):
+
+        ''' Returns True if the scan is paused '''
+
+        return self._run_event.is_set() is False
+
+
+    def wait_if_paused(self):
+
+        ''' Blocks while the scan is paused. Returns False if the scan has been
+        stopped '''
+
+        self._run_event.wait()
+        return self.is_stopped() is False
+
+
+    def sleep(self,delay):
+
+        ''' Sleeps during <delay> seconds, or less if the scan is stopped in the
+        meantime. Returns False if the scan has been stopped '''
+
+        return self._stop_event.wait(delay) is False
+
+
+
+    # Timing hooks
+    # =========================================================================
+
+    def add_hook(self,callback):
+
+        ''' Register a function called as callback(event, name, duration) when
+        a step starts (event 'started', duration None) and when it finishes
+        (event 'finished', duration in seconds) '''
+
+        self._hooks.append(callback)
+
+
+    def remove_hook(self,callback):
+
+        ''' Unregister a timing hook '''
+
+        self._hooks.remove(callback)
+
+
+    @contextmanager
+    def step(self,name):
+
+        ''' Context manager surrounding the execution of the step <name>, which
+        calls the timing hooks '''
+
+        for hook in self._hooks : hook('started',name,None)
+        start = time.perf_counter()
+        try :
+            yield
+        finally :
+            duration = time.perf_counter()-start
+            for hook in self._hooks : hook('finished',name,duration)
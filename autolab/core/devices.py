@@ -5,6 +5,7 @@ Created on Thu Jun 13 10:25:49 2019
 @author: quentin.chateiller
 """
 
+import threading
 
 from . import drivers
 from .elements import Module
@@ -14,21 +15,77 @@ from . import config
 # Storage of the devices
 DEVICES = {}
 
+# Locks of the devices {device_name: Lock}: a device is loaded by one thread at a time
+DEVICES_LOCKS = {}
+DEVICES_LOCK = threading.Lock()
+
+# Options of devices_config.ini handled by autolab, not sent to the driver
+DEVICE_OPTIONS = ['cache_ttl']
+
 
 
 def get_element_by_address(address):
 
-    """ Returns the Element located at the provided address """
+    """ Returns the Element located at the provided address <device.module.variable>.
+    The device is loaded if not already done. """
+
+    device_name = address.split('.')[0]
+    device = DEVICES[device_name] if device_name in DEVICES else get_device(device_name)
+    return device.get_element(address[len(device_name)+1:])
+
+
+
+def read_many(addresses):
+
+    ''' Reads the Variables at the provided addresses and returns a dict {address: value}.
+    The variables are grouped by instrument: the devices (and the independent modules, such as
+    the devices of a remote server) are read in parallel, and the variables
+    of a same device one after the other, or in a single request when its driver provides
+    a bulk query function '''
+
+    groups = {}
+    for address in addresses :
+        variable = get_element_by_address(address)
+        assert variable._element_type == 'variable' and variable.readable, f"The element '{address}' is not a readable variable"
+        groups.setdefault(variable._device(),[]).append((address,variable))
+
+    results = {}
+    if len(groups) > 1 :
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(groups)) as executor :
+            for answers in executor.map(read_device_variables,groups.values()) :
+                results.update(answers)
+    else :
+        for variables in groups.values() :
+            results.update(read_device_variables(variables))
+
+    return {address:results[address] for address in addresses}
+
+
+
+def read_device_variables(variables):
+
+    ''' Reads a list of (address, variable) of a same device, and returns a dict {address: value} '''
+
+    results = {}
+    bulks = {}
+    for address,variable in variables :
+        module = variable._parent
+        if module._bulk_query is not None and variable.query is not None and variable.cache_ttl is None :
+            bulks.setdefault(module,[]).append((address,variable))
+        else :
+            results[address] = variable()
 
-    address = address.split('.')
+    for module,items in bulks.items() :
+        if len(items) == 1 :
+            address,variable = items[0]
+            results[address] = variable()
+        else :
+            values = module.read_bulk([variable for address,variable in items])
+            for (address,variable),value in zip(items,values) :
+                results[address] = value
 
-    try :
-        element = get_device(address[0])
-        for addressPart in address[1:] :
-            element = getattr(element,addressPart)
-        return element
-    except :
-        pass
+    return results
 
 
 
@@ -61,17 +118,56 @@ def get_device(device_name, **kwargs):
 
     device_config = get_final_device_config(device_name, **kwargs)
 
-    if device_name in list_loaded_devices() :
-        assert device_config == DEVICES[device_name].device_config, f'You cannot change the configuration of an existing Device. Close it first & retry, or remove the provided configuration.'
+    # The threads asking for a device being loaded wait for it, instead of loading it again
+    with DEVICES_LOCK :
+        lock = DEVICES_LOCKS.setdefault(device_name,threading.Lock())
 
-    else :
-        instance = drivers.get_driver(device_config['driver'],
-                                       device_config['connection'],
-                                       **{ k:v for k,v in device_config.items() if k not in ['driver','connection']})
-        DEVICES[device_name] = Device(device_name,instance)
-        DEVICES[device_name].device_config = device_config
+    with lock :
+
+        if device_name in list_loaded_devices() :
+            assert device_config == DEVICES[device_name].device_config, f'You cannot change the configuration of an existing Device. Close it first & retry, or remove the provided configuration.'
+
+        else :
+            instance = drivers.get_driver(device_config['driver'],
+                                           device_config['connection'],
+                                           **{ k:v for k,v in device_config.items() if k not in ['driver','connection']+DEVICE_OPTIONS})
+            device = Device(device_name,instance,
+                            **{ k:v for k,v in device_config.items() if k in DEVICE_OPTIONS})
+            device.device_config = device_config
+            DEVICES[device_name] = device
+
+        return DEVICES[device_name]
+
+
+
+def get_devices(device_names=None, timeout=None):
+
+    ''' Loads several devices in parallel (all the configured devices by default), and returns
+    a dict {device_name: Device}, or the Exception raised if a device could not be loaded.
+    A device not loaded within timeout seconds gets a TimeoutError; its loading goes on in
+    background and it will be available with get_device once connected. '''
 
-    return DEVICES[device_name]
+    from concurrent.futures import ThreadPoolExecutor, wait
+
+    if device_names is None : device_names = list_devices()
+    device_names = list(dict.fromkeys(device_names)) # Unique names, same order
+    if len(device_names) == 0 : return {}
+
+    executor = ThreadPoolExecutor(max_workers=len(device_names),thread_name_prefix='autolab-get-devices')
+    futures = {name:executor.submit(get_device,name) for name in device_names}
+    wait(futures.values(),timeout=timeout)
+    executor.shutdown(wait=False)
+
+    results = {}
+    for name,future in futures.items() :
+        if not future.done() :
+            results[name] = TimeoutError(f"Device {name} not loaded after {timeout} s")
+        elif future.exception() is not None :
+            results[name] = future.exception()
+        else :
+            results[name] = future.result()
+
+    return results
 
 
 
@@ -110,17 +206,30 @@ def get_devices_status():
 
 class Device(Module):
 
-    def __init__(self,device_name,instance):
+    def __init__(self,device_name,instance,cache_ttl=None):
 
         Module.__init__(self,None,{'name':device_name,
                                    'object':instance,
-                                   'help':f'Device {device_name}'})
+                                   'help':f'Device {device_name}',
+                                   'cache_ttl':cache_ttl})
+
+
+    def io_statistics(self):
+
+        """ Returns the statistics of the accesses to this device: number of calls,
+        current and maximal number of requests waiting, total and maximal wait time """
+
+        return self._io_lock.statistics()
 
 
     def close(self):
 
         """ This function close the connection of the current physical device """
 
+        for module in self._independent_modules() :
+            if module._executor is not None :
+                module._executor.shutdown(wait=True)
+                module._executor = None
         try : self.instance.close()
         except : pass
         del DEVICES[self.name]
@@ -130,4 +239,4 @@ class Device(Module):
 
         """ For auto-completion """
 
-        return  self.list_modules() + self.list_variables() + self.list_actions() + ['close','help','instance']
+        return  self.list_modules() + self.list_variables() + self.list_actions() + ['close','help','instance','cache_info','clear_cache','io_statistics','get_element']
@@ -5,11 +5,15 @@ Created on Tue Oct  1 17:38:15 2019
 @author: qchat
 """
 import os
+import sys
 import inspect
 import importlib
+import importlib.util
 import configparser
+import json
+import threading
 from .utilities import emphasize,underline,two_columns
-from . import paths, server
+from . import paths
 
 # =============================================================================
 # DRIVERS INSTANTIATION
@@ -20,6 +24,7 @@ def get_driver(driver_name,connection_type,**kwargs):
     ''' Returns a driver instance using configuration provided in kwargs '''
 
     if driver_name == 'autolab_server' :
+        from . import server
         driver_instance = server.Driver_REMOTE(**kwargs)
 
     else :
@@ -46,27 +51,51 @@ def load_driver_lib(driver_name):
 
 
 
+# Loaded libraries {path: (modification time, library)}
+LIBS_CACHE = {}
+LIBS_LOCK = threading.RLock()
+
+
 def load_lib(lib_path):
 
-    ''' Return an instance of the python script located at lib_path '''
+    ''' Return an instance of the python script located at lib_path.
+    The script is executed once, and again only if the file has been modified '''
+
+    mtime = os.path.getmtime(lib_path)
+
+    with LIBS_LOCK :
 
-    lib_name = os.path.basename(lib_path).split('.')[0]
+        if lib_path in LIBS_CACHE and LIBS_CACHE[lib_path][0] == mtime :
+            return LIBS_CACHE[lib_path][1]
 
-    # Save current working directory path
-    curr_dir = os.getcwd()
+        lib_name = os.path.basename(lib_path).split('.')[0]
+        lib_dir = os.path.dirname(lib_path)
 
-    # Go to the driver's directory (in case it contains absolute imports)
-    os.chdir(os.path.dirname(lib_path))
+        # The driver's directory is added to the python path while loading, in case
+        # it contains absolute imports (under the lock, sys.path being shared)
+        sys.path.insert(0,lib_dir)
+        try :
+            spec = importlib.util.spec_from_file_location(lib_name, lib_path)
+            lib = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(lib)
+        finally :
+            sys.path.remove(lib_dir)
 
-    # Load the module
-    spec = importlib.util.spec_from_file_location(lib_name, lib_path)
-    lib = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(lib)
+        LIBS_CACHE[lib_path] = (mtime,lib)
+        return lib
 
-    # Come back to previous working directory
-    os.chdir(curr_dir)
 
-    return lib
+
+def reload_driver(driver_name):
+
+    ''' Forces the reloading of the library of a driver (and of its utilities file),
+    and returns it. Devices already loaded keep using their current instance '''
+
+    driver_dir = os.path.dirname(get_driver_path(driver_name))
+    with LIBS_LOCK :
+        for lib_path in list(LIBS_CACHE.keys()) :
+            if os.path.dirname(lib_path) == driver_dir : del LIBS_CACHE[lib_path]
+        return load_driver_lib(driver_name)
 
 
 
@@ -88,26 +117,10 @@ def load_driver_utilities_lib(driver_utilities_name):
 
 def load_utilities_lib(lib_path):
 
-    ''' Return an instance of the python script located at lib_path '''
-
-    lib_name = os.path.basename(lib_path).split('.')[0]
+    ''' Return an instance of the utilities script of the driver located at lib_path '''
 
-    # Save current working directory path
-    curr_dir = os.getcwd()
-
-    # Go to the driver's directory (in case it contains absolute imports)
-    os.chdir(os.path.dirname(lib_path))
-
-    # Load the module
-    lib_name = lib_name + '_utilities'
-    spec = importlib.util.spec_from_file_location(lib_name, os.path.join(os.path.dirname(lib_path),f'{lib_name}.py'))
-    lib = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(lib)
-
-    # Come back to previous working directory
-    os.chdir(curr_dir)
-
-    return lib
+    lib_name = os.path.basename(lib_path).split('.')[0] + '_utilities'
+    return load_lib(os.path.join(os.path.dirname(lib_path),f'{lib_name}.py'))
 
 # =============================================================================
 # DRIVERS LIST HELP
@@ -151,16 +164,44 @@ def get_connection_names(driver_lib):
 
 def get_driver_category(driver_name):
 
-    ''' Returns the driver's category (from class Driver) '''
+    ''' Returns the driver's category (from the driver utilities file) '''
+
+    entry = get_driver_cache_entry(driver_name)
+
+    if 'category' not in entry :
+        driver_utilities_path = os.path.join(os.path.dirname(get_driver_path(driver_name)),f'{driver_name}_utilities.py')
+        category = 'Other'
+        if os.path.exists(driver_utilities_path) :
+            driver_utilities = load_lib(driver_utilities_path)
+            if hasattr(driver_utilities,'category') :
+                category = driver_utilities.category
+        update_driver_cache_entry(driver_name,'category',category)
+
+    return entry['category']
 
-    driver_utilities_path = os.path.join(os.path.dirname(get_driver_path(driver_name)),f'{driver_name}_utilities.py')
-    category = 'Other'
-    if os.path.exists(driver_utilities_path) :
-        driver_utilities = load_lib(driver_utilities_path)
-        if hasattr(driver_utilities,'category') :
-            category = driver_utilities.category
 
-    return category
+
+def get_driver_infos(driver_name):
+
+    ''' Returns the metadata of a driver: category, connections types and their
+    arguments, arguments of the class Driver, slot configuration and modules.
+    Read from the drivers cache if the driver files did not change '''
+
+    entry = get_driver_cache_entry(driver_name)
+
+    if 'library' not in entry :
+        driver_lib = load_driver_lib(driver_name)
+        driver_class = get_driver_class(driver_lib)
+        infos = {}
+        infos['connection'] = {conn:get_class_args(get_connection_class(driver_lib,conn))
+                               for conn in get_connection_names(driver_lib)}
+        infos['other'] = get_class_args(driver_class)
+        infos['slot_config'] = getattr(driver_class,'slot_config',None)
+        infos['modules'] = {module:getattr(get_module_class(driver_lib,module),'category',None)
+                            for module in get_module_names(driver_lib)}
+        update_driver_cache_entry(driver_name,'library',infos)
+
+    return dict(entry['library'],category=get_driver_category(driver_name))
 
 
 
@@ -249,6 +290,7 @@ def get_driver_path(driver_name):
 
     ''' Returns the config associated with driver_name '''
 
+    if DRIVERS_PATHS is None : update_drivers_paths()
     assert driver_name in DRIVERS_PATHS.keys(), f'Driver {driver_name} not found.'
     return DRIVERS_PATHS[driver_name]['path']
 
@@ -272,9 +314,119 @@ def load_drivers_paths():
     return drivers_paths
 
 
+# =============================================================================
+# DRIVERS METADATA CACHE
+# =============================================================================
+
+# Metadata of the drivers {driver_name: entry}, loaded from paths.DRIVERS_CACHE at first use
+DRIVERS_CACHE = None
+DRIVERS_CACHE_LOCK = threading.RLock()
+
+
+def get_driver_files_signature(driver_name):
+
+    ''' Returns the signature {filename: [mtime, size]} of the python files of a driver '''
+
+    driver_dir = os.path.dirname(get_driver_path(driver_name))
+    signature = {}
+    for filename in sorted(os.listdir(driver_dir)) :
+        if filename.endswith('.py') :
+            stat = os.stat(os.path.join(driver_dir,filename))
+            signature[filename] = [stat.st_mtime,stat.st_size]
+    return signature
+
+
+def get_driver_files_hash(driver_name):
+
+    ''' Returns the sha256 hash of the content of the python files of a driver '''
+
+    import hashlib
+
+    driver_dir = os.path.dirname(get_driver_path(driver_name))
+    sha = hashlib.sha256()
+    for filename in sorted(os.listdir(driver_dir)) :
+        if filename.endswith('.py') :
+            sha.update(filename.encode())
+            with open(os.path.join(driver_dir,filename),'rb') as file :
+                sha.update(file.read())
+    return sha.hexdigest()
+
+
+def get_driver_cache_entry(driver_name):
+
+    ''' Returns the cache entry of a driver, emptied if its files have been modified.
+    The files are only hashed if their modification times or sizes changed '''
+
+    global DRIVERS_CACHE
+
+    with DRIVERS_CACHE_LOCK :
+
+        if DRIVERS_CACHE is None : DRIVERS_CACHE = load_drivers_cache()
+
+        path = get_driver_path(driver_name)
+        signature = get_driver_files_signature(driver_name)
+        entry = DRIVERS_CACHE.get(driver_name)
+
+        if entry is None or entry.get('path') != path :
+            entry = None
+        elif entry.get('files') != signature :
+            # Modification times changed (copy, checkout...): check the content
+            files_hash = get_driver_files_hash(driver_name)
+            if entry.get('hash') == files_hash :
+                entry['files'] = signature
+                save_drivers_cache()
+            else :
+                entry = None
+
+        if entry is None :
+            entry = {'path':path,'files':signature,'hash':get_driver_files_hash(driver_name)}
+            DRIVERS_CACHE[driver_name] = entry
+
+        return entry
+
+
+def update_driver_cache_entry(driver_name,key,value):
+
+    ''' Stores a metadata of a driver in the cache and saves it '''
+
+    with DRIVERS_CACHE_LOCK :
+        get_driver_cache_entry(driver_name)[key] = value
+        save_drivers_cache()
+
+
+def load_drivers_cache():
+
+    ''' Loads the drivers cache file, or returns an empty cache if not available '''
+
+    try :
+        with open(paths.DRIVERS_CACHE) as file :
+            cache = json.load(file)
+        assert isinstance(cache,dict)
+        return cache
+    except Exception :
+        return {}
+
+
+def save_drivers_cache():
+
+    ''' Saves the drivers cache file (atomically). Failures are ignored, the cache
+    being then only kept in memory '''
+
+    try :
+        temp_path = paths.DRIVERS_CACHE+'.tmp'
+        with open(temp_path,'w') as file :
+            json.dump(DRIVERS_CACHE,file,default=str)
+        os.replace(temp_path,paths.DRIVERS_CACHE)
+    except Exception :
+        pass
+
+
 def update_drivers_paths():
-    global DRIVERS_PATH
+
+    ''' (Re)loads the paths of the drivers '''
+
+    global DRIVERS_PATHS
     DRIVERS_PATHS = load_drivers_paths()
 
-# Loading the drivers informations at startup
-DRIVERS_PATHS = load_drivers_paths()
+# Drivers informations, loaded at first use
+DRIVERS_PATHS = None
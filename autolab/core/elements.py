@@ -6,6 +6,8 @@ Created on Fri Oct 18 22:20:14 2019
 """
 
 import os
+import time
+import threading
 
 import inspect
 from .utilities import emphasize, clean_string
@@ -19,6 +21,16 @@ class Element() :
         self._element_type = element_type
         self._parent = parent
         self._help = None
+        self.last_call_duration = None # Duration of the last driver call (s)
+
+        # Index {address: element} of all the elements of the device, held by its top module.
+        # The elements are registered under their cleaned names, as in the modules
+        if parent is None :
+            self._index = {}
+            self._index_address = name
+        else :
+            self._index_address = parent._index_address+'.'+clean_string(name)
+        self._root()._index[self._index_address] = self
 
     def address(self):
 
@@ -30,6 +42,103 @@ class Element() :
 
 
 
+    def _root(self):
+
+        """ Returns the top element (Device) of the hierarchy of this element """
+
+        element = self
+        while element._parent is not None : element = element._parent
+        return element
+
+
+
+    def _device(self):
+
+        """ Returns the module holding the state of the instrument of this element (lock,
+        read cache generation, executor): the top module (Device), or a submodule declared
+        'independent' by its driver, for instance a device of a remote autolab server """
+
+        element = self
+        while not getattr(element,'_independent',False) : element = element._parent
+        return element
+
+
+
+    def _run_async(self,function,*args):
+
+        """ Runs function(*args) in the executor of the device (one thread per device,
+        so that the blocking drivers calls are serialised) and returns an awaitable """
+
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        device = self._device()
+        with device._executor_lock :
+            if device._executor is None :
+                device._executor = ThreadPoolExecutor(max_workers=1,thread_name_prefix=f'autolab-{device.address()}')
+        return asyncio.get_event_loop().run_in_executor(device._executor,function,*args)
+
+
+
+
+
+
+class IOLock() :
+
+    """ Re-entrant lock serialising the accesses to a device from several 
+    threads (GUI, monitors, scans...), with statistics about the requests 
+    waiting for it """
+
+    def __init__(self):
+
+        self._lock = threading.RLock()
+        self._stats_lock = threading.Lock()
+        self.queue_depth = 0        # Number of requests currently waiting
+        self.max_queue_depth = 0
+        self.calls = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+
+
+    def __enter__(self):
+
+        with self._stats_lock :
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth,self.queue_depth)
+
+        start = time.perf_counter()
+        self._lock.acquire()
+        wait = time.perf_counter()-start
+
+        with self._stats_lock :
+            self.queue_depth -= 1
+            self.calls += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait,wait)
+
+        return self
+
+
+    def __exit__(self,*args):
+
+        self._lock.release()
+
+
+    def statistics(self):
+
+        """ Returns the statistics of the accesses to the device """
+
+        with self._stats_lock :
+            return {'calls':self.calls,
+                    'queue_depth':self.queue_depth,
+                    'max_queue_depth':self.max_queue_depth,
+                    'total_wait':self.total_wait,
+                    'max_wait':self.max_wait}
+
+
+
+
+
 
 
 
@@ -39,7 +148,8 @@ class Module(Element):
 
         Element.__init__(self,parent,'module',config['name'])
 
-        self._mod = {}
+        self._mod = {}          # Submodules, None until their first access
+        self._mod_configs = {}  # Configurations of the submodules not yet constructed
         self._var = {}
         self._act = {}
 
@@ -47,11 +157,28 @@ class Module(Element):
         assert 'object' in config.keys(), f"Module {self.name}: missing module object"
         self.instance = config['object']
 
+        # Default read cache time-to-live of the variables, inherited from the parent module
+        self._cache_ttl = parent._cache_ttl if parent is not None else None
+        if 'cache_ttl' in config.keys():
+            self._cache_ttl = check_cache_ttl(config['cache_ttl'],f"Module {self.name}")
+        # A module is independent from its parent if it is a separate instrument
+        self._independent = parent is None or bool(config.get('independent',False))
+        if self._independent :
+            self._cache_generation = 0
+            self._io_lock = IOLock() # Serialises the accesses to the device
+            self._executor = None    # Thread used by the asynchronous API, created on first use
+            self._executor_lock = threading.Lock()
+
         # Help
         if 'help' in config.keys():
             assert isinstance(config['help'],str), f"Module {self.address()} configuration: Help parameter must be a string"
             self._help = config['help']
 
+        # Optional driver function answering several queries in a single request
+        self._bulk_query = getattr(self.instance,'bulk_query',None)
+        if self._bulk_query is not None :
+            assert inspect.ismethod(self._bulk_query), f"Module {self.address()} configuration: bulk_query must be a function"
+
         # Loading instance
         assert hasattr(self.instance,'get_driver_model'), f"There is no function 'get_driver_model' in the driver class"
         driver_config = self.instance.get_driver_model()
@@ -78,7 +205,9 @@ class Module(Element):
 
                 # Check name uniqueness
                 assert name not in self.get_names(), f"Module {self.name}, Submodule {name} configuration: '{name}' already exists"
-                self._mod[name] = Module(self,config_line)
+                assert 'object' in config_line.keys(), f"Module {self.name}, Submodule {name} configuration: missing module object"
+                self._mod[name] = None # Constructed on first access (see get_module)
+                self._mod_configs[name] = config_line
 
             elif element_type == 'variable':
 
@@ -98,7 +227,20 @@ class Module(Element):
 
         """ Returns the submodule of the given name """
 
-        assert name in self.list_modules(), f"The submodule '{name}' does not exist in module {self.name}"
+        assert name in self._mod, f"The submodule '{name}' does not exist in module {self.name}"
+        if self._mod[name] is None :
+            with self._device()._io_lock : # Calls get_driver_model of the submodule
+                if self._mod[name] is None :
+                    try :
+                        self._mod[name] = Module(self,self._mod_configs[name])
+                    except :
+                        # The config is kept to try again, the elements already indexed are forgotten
+                        index = self._root()._index
+                        prefix = self._index_address+'.'+name
+                        for address in [address for address in index if address == prefix or address.startswith(prefix+'.')] :
+                            del index[address]
+                        raise
+                    del self._mod_configs[name]
         return self._mod[name]
 
 
@@ -115,7 +257,7 @@ class Module(Element):
 
         """ Returns the variable with the given name """
 
-        assert name in self.list_variables(), f"The variable '{name}' does not exist in module {self.name}"
+        assert name in self._var, f"The variable '{name}' does not exist in module {self.name}"
         return self._var[name]
 
 
@@ -132,7 +274,7 @@ class Module(Element):
 
         """ Returns the action with the given name """
 
-        assert name in self.list_actions(), f"The action '{name}' does not exist in device {self.name}"
+        assert name in self._act, f"The action '{name}' does not exist in device {self.name}"
         return self._act[name]
 
 
@@ -153,12 +295,96 @@ class Module(Element):
 
 
 
+    def get_element(self,address):
+
+        """ Returns the element located at the provided address, relative to this module
+        <submodule.variable> (looked up in the index of the device) """
+
+        full_address = self._index_address+'.'+address if address != '' else self._index_address
+        element = self._root()._index.get(full_address)
+
+        # The element may be in submodules not yet constructed
+        if element is None :
+            module = self
+            for name in address.split('.') :
+                if name not in module._mod : break
+                module = module.get_module(name)
+            element = self._root()._index.get(full_address)
+
+        assert element is not None, f"No element found at address '{full_address}'"
+        return element
+
+
+
     def __getattr__(self,attr):
 
-        if attr in self.list_variables() : return self.get_variable(attr)
-        elif attr in self.list_actions() : return self.get_action(attr)
-        elif attr in self.list_modules() : return self.get_module(attr)
-        else : raise AttributeError(f"'{attr}' not found in module '{self.name}'")
+        # Only called if attr is not a regular attribute: direct lookups in the elements dicts
+        elements = self.__dict__
+        for kind in ['_var','_act'] :
+            if kind in elements and attr in elements[kind] : return elements[kind][attr]
+        if '_mod' in elements and attr in elements['_mod'] : return self.get_module(attr)
+        raise AttributeError(f"'{attr}' not found in module '{self.__dict__.get('name')}'")
+
+
+    def clear_cache(self):
+
+        """ Invalidates the read cache of all the variables of the device """
+
+        for module in self._independent_modules() :
+            module._cache_generation += 1
+
+
+
+    def _independent_modules(self):
+
+        """ Returns the Device and its independent submodules already constructed """
+
+        return [element for element in self._root()._index.values()
+                if element._element_type == 'module' and element._independent]
+
+
+
+    def cache_info(self):
+
+        """ Returns a dictionnary {address: statistics} of the read cache of the
+        variables of this module (and submodules) which have a read cache """
+
+        info = {}
+        for module in self._mod.values() :
+            if module is not None : info.update(module.cache_info()) # Not constructed: never read
+        for var in self.list_variables() :
+            variable = self.get_variable(var)
+            if variable.cache_ttl is not None :
+                info[variable.address()] = variable.cache_info()
+        return info
+
+
+
+    def read_bulk(self,variables):
+
+        """ Reads several variables of this module declaring a 'query', in a single
+        request to the instrument through the bulk query function of the driver.
+        Returns the list of the values, in the same order """
+
+        assert self._bulk_query is not None, f"Module {self.address()}: the driver does not provide a bulk query function"
+        for variable in variables :
+            assert variable._parent is self and variable.query is not None, f"Variable {variable.address()} cannot be read by the bulk query of module {self.address()}"
+
+        device = self._device()
+        with device._io_lock :
+            start = time.perf_counter()
+            answers = self._bulk_query([variable.query for variable in variables])
+            duration = time.perf_counter()-start
+        assert len(answers) == len(variables), f"Module {self.address()}: the bulk query returned {len(answers)} answers for {len(variables)} queries"
+
+        values = []
+        for variable,answer in zip(variables,answers) :
+            value = variable.parse_answer(answer)
+            variable.last_call_duration = duration/len(variables)
+            if variable._read_signal is not None : variable._read_signal.emit(value)
+            values.append(value)
+        return values
+
 
 
     def get_structure(self):
@@ -234,7 +460,7 @@ class Module(Element):
 
         """ For auto-completion """
 
-        return self.list_modules() + self.list_variables() + self.list_actions() + ['help','instance']
+        return self.list_modules() + self.list_variables() + self.list_actions() + ['help','instance','cache_info','clear_cache','get_element']
 
 
 
@@ -283,12 +509,29 @@ class Variable(Element):
             assert isinstance(config['help'],str), f"Variable {self.address()} configuration: Info parameter must be a string"
             self._help = config['help']
 
+        # Query string of the variable, to be merged with others in a bulk query (see Module.read_bulk)
+        self.query = None
+        if 'query' in config.keys():
+            assert isinstance(config['query'],str), f"Variable {self.address()} configuration: Query parameter must be a string"
+            assert self.type in [int,float,bool,str], f"Variable {self.address()} configuration: Query parameter only allowed for types int, float, bool and str"
+            self.query = config['query']
+
         # Properties
         self.writable = self.write_function is not None
         self.readable = self.read_function is not None
         self.numerical = self.type in [int,float]
         self.parameter_allowed = self.writable and self.numerical
 
+        # Read cache (time-to-live in seconds, None if disabled)
+        self.cache_ttl = parent._cache_ttl if self.readable else None
+        if 'cache_ttl' in config.keys():
+            self.cache_ttl = check_cache_ttl(config['cache_ttl'],f"Variable {self.address()}")
+        self._cache_value = None
+        self._cache_time = None
+        self._cache_generation = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+
         # Signals for GUI
         self._read_signal = None
         self._write_signal = None
@@ -322,6 +565,54 @@ class Variable(Element):
 
 
 
+    def parse_answer(self,answer):
+
+        """ Converts a raw answer of the instrument to the type of the variable """
+
+        if isinstance(answer,str) :
+            answer = answer.strip()
+            if self.type in [int,bool] : answer = float(answer) # e.g. '+1.000E+00'
+        return self.type(answer)
+
+
+
+    def clear_cache(self):
+
+        """ Invalidates the read cache of this variable """
+
+        self._cache_time = None
+
+
+
+    def cache_info(self):
+
+        """ Returns the statistics of the read cache of this variable """
+
+        return {'ttl':self.cache_ttl,'hits':self.cache_hits,'misses':self.cache_misses}
+
+
+
+    async def aread(self):
+
+        """ Asynchronous version of variable(): awaitable measure of the variable.
+        The driver call is done in the executor of the device, which allows to
+        gather measures of several devices from a single event loop """
+
+        assert self.readable, f"The variable {self.name} is not readable"
+        return await self._run_async(self.__call__)
+
+
+
+    async def awrite(self,value):
+
+        """ Asynchronous version of variable(value): awaitable set of the variable """
+
+        assert self.writable, f"The variable {self.name} is not writable"
+        assert value is not None, f"The variable {self.name} cannot be set to None"
+        await self._run_async(self.__call__,value)
+
+
+
     def help(self):
 
         """ This function prints informations for the user about the current variable """
@@ -351,6 +642,9 @@ class Variable(Element):
         if self.unit is not None : display += f'{self.unit}\n'
         else : display += 'None\n'
 
+        if self.cache_ttl is not None :
+            display += f'Read cache: {self.cache_ttl} s ({self.cache_hits} hits, {self.cache_misses} misses)\n'
+
         return display
 
 
@@ -362,7 +656,28 @@ class Variable(Element):
         # GET FUNCTION
         if value is None:
             assert self.readable, f"The variable {self.name} is not readable"
-            answer = self.read_function()
+
+            device = self._device()
+            with device._io_lock :
+
+                # Cached value still valid (not too old, and no write in the device since then)
+                if ( self.cache_ttl is not None and self._cache_time is not None
+                    and time.monotonic()-self._cache_time < self.cache_ttl
+                    and self._cache_generation == device._cache_generation ) :
+                    self.cache_hits += 1
+                    self.last_call_duration = 0
+                    answer = self._cache_value
+
+                else :
+                    start = time.perf_counter()
+                    answer = self.read_function()
+                    self.last_call_duration = time.perf_counter()-start
+                    if self.cache_ttl is not None :
+                        self.cache_misses += 1
+                        self._cache_value = answer
+                        self._cache_time = time.monotonic()
+                        self._cache_generation = device._cache_generation
+
             if self._read_signal is not None : self._read_signal.emit(answer)
             return answer
 
@@ -370,7 +685,12 @@ class Variable(Element):
         else :
             assert self.writable, f"The variable {self.name} is not writable"
             value = self.type(value)
-            self.write_function(value)
+            device = self._device()
+            with device._io_lock :
+                start = time.perf_counter()
+                self.write_function(value)
+                self.last_call_duration = time.perf_counter()-start
+                device._cache_generation += 1 # Invalidates the read caches of the device
             if self._write_signal is not None : self._write_signal.emit()
 
 
@@ -452,7 +772,38 @@ class Action(Element):
         if self.has_parameter :
             assert value is not None, f"The action {self.name} requires an argument"
             value = self.type(value)
-            self.function(value)
         else :
             assert value is None, f"The action {self.name} doesn't require an argument"
-            self.function()
+
+        device = self._device()
+        with device._io_lock :
+            start = time.perf_counter()
+            if self.has_parameter : self.function(value)
+            else : self.function()
+            self.last_call_duration = time.perf_counter()-start
+            device._cache_generation += 1 # Invalidates the read caches of the device
+
+
+
+    async def arun(self,value=None):
+
+        """ Asynchronous version of action(value): awaitable execution of the action """
+
+        await self._run_async(self.__call__,value)
+
+
+
+
+
+
+
+
+def check_cache_ttl(cache_ttl,name):
+
+    """ Returns the read cache time-to-live (s) as a float, or None if disabled """
+
+    if cache_ttl is None : return None
+    try : cache_ttl = float(cache_ttl)
+    except : raise ValueError(f"{name} configuration: cache_ttl must be numerical")
+    assert cache_ttl >= 0, f"{name} configuration: cache_ttl must be positive"
+    return cache_ttl
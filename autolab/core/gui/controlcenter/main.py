@@ -12,10 +12,15 @@ from PyQt5 import QtCore, QtWidgets, uic, QtGui
 import os
 from ..scanning.main import Scanner
 
-from .thread import ThreadManager
+from .thread import ThreadManager, LoadingThread
 from .treewidgets import TreeWidgetItemModule
 
 
+# Time given to each device to connect with the action 'Connect all' (s)
+CONNECT_TIMEOUT = 30
+
+
+
 class ControlCenter(QtWidgets.QMainWindow):
 
     def __init__(self):
@@ -37,6 +42,7 @@ class ControlCenter(QtWidgets.QMainWindow):
         self.tree.header().resizeSection(4, 15)
         self.tree.header().setStretchLastSection(False)
         self.tree.itemClicked.connect(self.itemClicked)
+        self.tree.itemExpanded.connect(self.itemExpanded)
         self.tree.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
         self.tree.customContextMenuRequested.connect(self.rightClick)
         self.tree.setAlternatingRowColors(True)
@@ -49,6 +55,12 @@ class ControlCenter(QtWidgets.QMainWindow):
         self.monitors = {}
 
 
+        self.connectAction = self.menuBar.addAction('Connect all')
+        self.connectAction.triggered.connect(self.connectAll)
+        self.connectAction.setToolTip('Load in parallel all the devices configured in devices_config.ini')
+        self.loadingThread = None
+
+
         scanAction = self.menuBar.addAction('Open scanner')
         scanAction.triggered.connect(self.openScanner)
         scanAction.setToolTip('Open the scanner in another window')
@@ -116,6 +128,55 @@ class ControlCenter(QtWidgets.QMainWindow):
 
 
 
+    def itemExpanded(self,item):
+
+        """ Function called when an item has been expanded in the tree.
+            Loads the submodule (and constructs it in the device) if not already done """
+
+        if item.parent() is not None and hasattr(item,'loaded') and item.loaded is False :
+            try :
+                item.load(getattr(item.parent().module,item.name))
+            except Exception as e :
+                self.setStatus(f'An error occured when loading module {item.name} : {str(e)}')
+
+
+
+    def connectAll(self):
+
+        """ Function called to load in parallel all the devices not yet loaded, in
+        another thread. A device not connected within CONNECT_TIMEOUT seconds is reported
+        as not loaded (it can still be associated later by clicking on it) """
+
+        if self.loadingThread is not None and self.loadingThread.isRunning() : return
+        names = [name for name in devices.list_devices() if name not in devices.list_loaded_devices()]
+        if len(names) == 0 : return
+
+        self.setStatus('Loading all devices...')
+        self.connectAction.setEnabled(False)
+        self.loadingThread = LoadingThread(names,CONNECT_TIMEOUT)
+        self.loadingThread.endSignal.connect(self.connectAllFinished)
+        self.loadingThread.start()
+
+
+
+    def connectAllFinished(self,results):
+
+        """ Function called when the devices have been loaded by connectAll:
+        associates them to their items in the tree """
+
+        self.connectAction.setEnabled(True)
+
+        for i in range(self.tree.topLevelItemCount()) :
+            item = self.tree.topLevelItem(i)
+            if item.loaded is False and item.name in devices.list_loaded_devices() :
+                self.associate(item)
+
+        errors = [f'{name} ({str(result)})' for name,result in results.items() if isinstance(result,Exception)]
+        if len(errors) > 0 : self.setStatus('Devices not loaded: '+', '.join(errors))
+        else : self.clearStatus()
+
+
+
     def associate(self,item):
 
         """ Function called to associate a main module to one item in the tree """
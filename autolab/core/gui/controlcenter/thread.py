@@ -6,6 +6,7 @@ Created on Sun Sep 29 18:26:32 2019
 """
 
 from PyQt5 import QtCore
+from ... import devices
 
 class ThreadManager :
     
@@ -105,4 +106,28 @@ class InteractionThread(QtCore.QThread):
             error = e
         self.endSignal.emit(error)
        
-        
\ No newline at end of file
+                
+        
+        
+        
+        
+        
+class LoadingThread(QtCore.QThread):
+    
+    """ This class is dedicated to the loading of several devices in parallel, in a new thread """
+    
+    endSignal = QtCore.pyqtSignal(object)
+    
+    
+    def __init__(self,deviceNames,timeout):
+        QtCore.QThread.__init__(self)
+        self.deviceNames = deviceNames
+        self.timeout = timeout
+        
+        
+        
+    def run(self):
+        
+        """ Loads the devices, and emits the dict {device name: Device or Exception} """
+        
+        self.endSignal.emit(devices.get_devices(self.deviceNames,timeout=self.timeout))
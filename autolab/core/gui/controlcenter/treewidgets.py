@@ -37,9 +37,8 @@ class TreeWidgetItemModule(QtWidgets.QTreeWidgetItem):
         # Submodules
         subModuleNames = self.module.list_modules()
         for subModuleName in subModuleNames :
-            subModule = getattr(self.module,subModuleName)
             item = TreeWidgetItemModule(self, subModuleName,self.gui)
-            item.load(subModule)
+            item.setChildIndicatorPolicy(QtWidgets.QTreeWidgetItem.ShowIndicator) # Loaded when expanded
 
         # Variables
         varNames = self.module.list_variables()
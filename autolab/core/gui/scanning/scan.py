@@ -6,11 +6,10 @@ Created on Sun Sep 29 18:08:45 2019
 """
 
 from PyQt5 import QtCore
-import time
-import threading
 import numpy as np
 import collections
 import math as m
+from ...control import ScanControl
 
 class ScanManager :
     
@@ -107,7 +106,7 @@ class ScanManager :
         """ This function stop manually the scan """
         
         self.disableContinuousMode()   
-        self.thread.stopFlag.set()
+        self.thread.control.stop()
         self.resume()
         self.thread.wait()
         
@@ -188,7 +187,7 @@ class ScanManager :
         
         """ Returns True or False whether the scan is paused or not """
         
-        return self.thread is not None and self.thread.pauseFlag.is_set() is True 
+        return self.thread is not None and self.thread.control.is_paused() is True 
     
     
                
@@ -196,7 +195,7 @@ class ScanManager :
         
         """ This function pauses the scan """
         
-        self.thread.pauseFlag.set()
+        self.thread.control.pause()
         self.gui.dataManager.timer.stop()
         self.gui.pause_pushButton.setText('Resume')
         
@@ -206,7 +205,7 @@ class ScanManager :
         
         """ This function resumes the scan """
         
-        self.thread.pauseFlag.clear()
+        self.thread.control.resume()
         self.gui.dataManager.timer.start()
         self.gui.pause_pushButton.setText('Pause')
         
@@ -237,8 +236,19 @@ class ScanThread(QtCore.QThread):
         self.config = config
         self.queue = queue
         
-        self.pauseFlag = threading.Event()
-        self.stopFlag = threading.Event()
+        # Pause and stop requests, step timing hooks
+        self.control = ScanControl()
+        self.control.add_hook(self.stepHook)
+        
+        
+        
+    def stepHook(self,event,name,duration):
+        
+        """ This function is called at the start and at the end of each recipe 
+        step, and sends the corresponding signal to the GUI """
+        
+        if event == 'started' : self.startStepSignal.emit(name)
+        elif event == 'finished' : self.finishStepSignal.emit(name)
         
         
         
@@ -260,7 +270,7 @@ class ScanThread(QtCore.QThread):
         # Start the scan
         for paramValue in paramValues : 
                         
-            if self.stopFlag.is_set() is False :
+            if self.control.is_stopped() is False :
                 
                 try : 
                     
@@ -275,19 +285,18 @@ class ScanThread(QtCore.QThread):
                     dataPoint = self.processRecipe(dataPoint)
                     
                     # Send the whole data in the queue
-                    if self.stopFlag.is_set() is False : self.queue.put(dataPoint)
+                    if self.control.is_stopped() is False : self.queue.put(dataPoint)
 
 
                 except Exception as e :
 
                     # If an error occurs, stop the scan and send an error signal
                     self.errorSignal.emit(e)
-                    self.stopFlag.set()
+                    self.control.stop()
                     
                     
                 # Wait until the scan is no more in pause
-                while self.pauseFlag.is_set() :
-                    time.sleep(0.1)
+                self.control.wait_if_paused()
                         
             else : 
                 break
@@ -300,7 +309,7 @@ class ScanThread(QtCore.QThread):
 
         for stepInfos in self.config['recipe'] : 
             
-            if self.stopFlag.is_set() is False :
+            if self.control.is_stopped() is False :
                 
                 # Process the recipe step
                 result = self.processElement(stepInfos)
@@ -308,8 +317,7 @@ class ScanThread(QtCore.QThread):
                     dataPoint[stepInfos['name']] =  result
                     
                 # Wait until the scan is no more in pause
-                while self.pauseFlag.is_set() :
-                    time.sleep(0.1)
+                self.control.wait_if_paused()
             
             else : 
                 break
@@ -327,20 +335,17 @@ class ScanThread(QtCore.QThread):
         element = stepInfos['element']
         stepType = stepInfos['stepType']
         
-        self.startStepSignal.emit(stepInfos['name'])
-            
         result = None
-        if stepType == 'measure' :
-            result = element()
-        if stepType == 'set' :
-            element(stepInfos['value'])
-        if stepType == 'action' :
-            if stepInfos['value'] is not None :
+        with self.control.step(stepInfos['name']) :
+            if stepType == 'measure' :
+                result = element()
+            if stepType == 'set' :
                 element(stepInfos['value'])
-            else :
-                element()
-            
-        self.finishStepSignal.emit(stepInfos['name'])
+            if stepType == 'action' :
+                if stepInfos['value'] is not None :
+                    element(stepInfos['value'])
+                else :
+                    element()
         
         return result
     
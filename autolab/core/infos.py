@@ -73,22 +73,20 @@ def config_help(driver_name, _print=True, _parser=False):
 
     ''' Display the help of a particular driver (connection types, modules, ...) '''
 
-    # Load list of all parameters
-    driver_lib = drivers.load_driver_lib(driver_name)
+    # Load list of all parameters (from the drivers cache if available)
+    driver_infos = drivers.get_driver_infos(driver_name)
     params = {}
     params['driver'] = driver_name
-    params['connection'] = {}
-    for conn in drivers.get_connection_names(driver_lib) :
-        params['connection'][conn] = drivers.get_class_args(drivers.get_connection_class(driver_lib,conn))
-    params['other'] = drivers.get_class_args(drivers.get_driver_class(driver_lib))
-    if hasattr(drivers.get_driver_class(driver_lib),'slot_config') :
-        params['other']['slot1'] = f'{drivers.get_driver_class(driver_lib).slot_config}'
+    params['connection'] = driver_infos['connection']
+    params['other'] = dict(driver_infos['other'])
+    if driver_infos['slot_config'] is not None :
+        params['other']['slot1'] = f"{driver_infos['slot_config']}"
         params['other']['slot1_name'] = 'my_<MODULE_NAME>'
 
     mess = '\n'
 
     # Name and category if available
-    submess = f'Driver "{driver_name}" ({drivers.get_driver_category(driver_name)})'
+    submess = f'Driver "{driver_name}" ({driver_infos["category"]})'
     mess += utilities.emphasize(submess,sign='=') + '\n'
 
     # Connections types
@@ -100,13 +98,11 @@ def config_help(driver_name, _print=True, _parser=False):
     mess += '\n'
 
     # Modules
-    if hasattr(drivers.get_driver_class(driver_lib),'slot_config') :
+    if driver_infos['slot_config'] is not None :
         mess += 'Available modules:\n'
-        modules = drivers.get_module_names(driver_lib)
-        for module in modules :
-            moduleClass = drivers.get_module_class(driver_lib,module)
+        for module,category in driver_infos['modules'].items() :
             mess += f' - {module}'
-            if hasattr(moduleClass,'category') : mess += f' ({moduleClass.category})'
+            if category is not None : mess += f' ({category})'
             mess += '\n'
         mess += '\n'
 
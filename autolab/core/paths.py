@@ -13,6 +13,7 @@ USER_FOLDER = os.path.join(os.path.expanduser('~'),'autolab')
 USER_LAST_CUSTOM_FOLDER = os.path.expanduser('~')
 DEVICES_CONFIG = os.path.join(USER_FOLDER,'devices_config.ini')
 AUTOLAB_CONFIG = os.path.join(USER_FOLDER,'autolab_config.ini')
+DRIVERS_CACHE = os.path.join(USER_FOLDER,'drivers_cache.json')
 
 DRIVER_SOURCES = {'main':os.path.join(os.path.dirname(os.path.dirname(__file__)),'drivers'),
                   'local':os.path.join(USER_FOLDER,'local_drivers')}
@@ -2,162 +2,382 @@
 
 import sys
 import socket
-import pickle
+import struct
 import threading
+import itertools
+import collections
+import selectors
+import queue
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from . import config, devices
+from .codec import CODECS
 import datetime as dt
-from functools import partial
+
+
+# Header of each message: magic bytes, message type (codec), payload size (bytes)
+MAGIC = b'ALB\x01'
+HEADER = struct.Struct('!4sBQ')
+
+# Messages smaller than this are sent in a single packet (no Nagle delay)
+SMALL_MESSAGE_SIZE = 65536
+
+# Largest message accepted from a client, before and after the handshake (bytes)
+MAX_MESSAGE_SIZE = 256*1024*1024
+MAX_HANDSHAKE_SIZE = 4096
+
+# Above this amount of data waiting to be sent to a client, the samples of its
+# subscriptions are kept on the server (backpressure)
+MAX_OUTPUT_SIZE = 1024*1024
+
+
+
+def get_frame_parts(codec, object):
+
+    ''' Returns the parts (header, payload parts) of the message encoding object. The
+    small messages are joined, the large buffers are kept as they are (no copy) '''
+
+    parts = codec.encode(object)
+    size = sum(memoryview(part).nbytes for part in parts)
+    header = HEADER.pack(MAGIC,codec.msg_type,size)
+    if size < SMALL_MESSAGE_SIZE : return [header+b''.join(parts)]
+    return [header]+[memoryview(part).cast('B') for part in parts]
+
+
+
+def get_handshake_fields(message):
+
+    ''' Returns the fields {NAME: value} of a handshake message 'AUTOLAB?NAME=value&...' '''
+
+    return dict(field.split('=',1) for field in message.split('?',1)[-1].split('&') if '=' in field)
+
 
 
 class Driver_SOCKET():
 
-    prefix = b'<AUTOLAB_START>'
-    suffix = b'<AUTOLAB_END>'
+    # Codec of the messages, negotiated during the handshake
+    codec = CODECS['autolab1']
+
+    def recv_into(self, buffer):
+
+        ''' Fills the provided buffer with data received from the socket '''
+
+        view = memoryview(buffer)
+        while len(view) > 0 :
+            nbytes = self.socket.recv_into(view)
+            assert nbytes != 0, 'Connection closed by remote host'
+            view = view[nbytes:]
+
 
-    def read(self, length=4096):
+    def read_frame(self):
 
-        ''' Read pickled object from autolab master and return python object '''
+        ''' Reads a message and returns its type and its payload (bytearray) '''
 
-        # First read
-        msg  = self.socket.recv(length)
-        assert msg != b'', 'Connection closed by remote host'
-        assert msg.startswith(self.prefix), 'Autolab communication structure not found in reply'
+        header = bytearray(HEADER.size)
+        self.recv_into(header)
+        magic, msg_type, size = HEADER.unpack(header)
+        assert magic == MAGIC, 'Autolab communication structure not found in reply'
 
-        # Continue reading up to suffix
-        while not msg.endswith(self.suffix):
-            msg += self.socket.recv(length)
+        payload = bytearray(size) # Preallocated, filled directly by the socket
+        self.recv_into(payload)
+        return msg_type, payload
 
-        # Clean msg (remove prefix and suffix) and unpicke it
-        msg = msg.lstrip(self.prefix).rstrip(self.suffix)
-        obj = pickle.loads(msg)
 
-        return obj
+    def send_parts(self, parts):
+
+        ''' Sends the parts of a message without joining them (scatter/gather I/O if available) '''
+
+        if not hasattr(self.socket,'sendmsg') : # Windows
+            for part in parts : self.socket.sendall(part)
+            return
+
+        parts = [memoryview(part).cast('B') for part in parts]
+        while parts :
+            nbytes = self.socket.sendmsg(parts[:512])
+            while parts and nbytes >= parts[0].nbytes :
+                nbytes -= parts[0].nbytes
+                parts.pop(0)
+            if nbytes > 0 : parts[0] = parts[0][nbytes:]
+
+
+    def read(self):
+
+        ''' Read an object from autolab master and return python object '''
+
+        msg_type, payload = self.read_frame()
+        assert msg_type == self.codec.msg_type, f'Unexpected message type {msg_type}'
+        return self.codec.decode(payload)
 
 
     def write(self,object):
 
-        ''' Send pickled object to autolab master '''
+        ''' Send an object to autolab master '''
+
+        self.send_parts(get_frame_parts(self.codec,object))
 
-        msg = self.prefix+pickle.dumps(object)+self.suffix
-        self.socket.send(msg)
 
 
 
 
+class ClientConnection():
 
-class ClientThread(threading.Thread,Driver_SOCKET):
+    ''' Connection of a client to the server, handled in the event loop of the server.
+    The messages are received and sent without blocking; the requests of a client are
+    executed by the workers of the server, one after the other for each device '''
 
     def __init__(self, client_socket, server):
-        threading.Thread.__init__(self)
+
         self.socket = client_socket
+        self.socket.setblocking(False)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.server = server
-        self.stop_flag = threading.Event()
         self.hostname = None
+        self.connection_time = time.monotonic()
+        self.closed = False
 
-    def run(self):
+        # Reception: header, then payload, both filled with recv_into
+        self._header = bytearray(HEADER.size)
+        self._view = memoryview(self._header)
+        self._msg_type = None
+        self._payload = None
 
-        # Handshaking
-        if self.handshake() is True :
-            # Start listening client commands
-            self.listen()
+        # Emission
+        self._output = collections.deque()
+        self._output_size = 0
+        self.codec = CODECS['autolab1'] # Until the handshake
 
-        # Close client socket
-        self.close()
+        # Variables streamed to this client {stream_id: Subscription}
+        self.subscriptions = {}
 
+        # Requests waiting to be executed, by device {device_name: deque of (number, request)},
+        # numbered in their order of arrival, and the devices of those in execution
+        self._queues = {}
+        self._request_numbers = itertools.count()
+        self._running = set()
 
-    def handshake(self):
+
+
+    # Messages
+    # =========================================================================
+
+    def on_readable(self):
+
+        ''' Receives available data, and processes the message once complete '''
+
+        try :
+            nbytes = self.socket.recv_into(self._view)
+        except (BlockingIOError,InterruptedError) :
+            return
+        except OSError :
+            return self.close()
+        if nbytes == 0 : return self.close() # Connection closed by the client
+
+        self._view = self._view[nbytes:]
+        if len(self._view) > 0 : return
+
+        if self._msg_type is None :
+            magic, msg_type, size = HEADER.unpack(self._header)
+            if magic != MAGIC : return self.close()
+            max_size = MAX_MESSAGE_SIZE if self.hostname is not None else MAX_HANDSHAKE_SIZE
+            if size > max_size :
+                self.server.log(f'Message of {size} bytes refused (maximum {max_size}), connection closed')
+                return self.close()
+            self._msg_type = msg_type
+            self._payload = bytearray(size)
+            self._view = memoryview(self._payload)
+            if size > 0 : return
+
+        msg_type, payload = self._msg_type, self._payload
+        self._msg_type = None
+        self._view = memoryview(self._header)
+        self.on_message(msg_type,payload)
+
+
+    def on_message(self, msg_type, payload):
+
+        ''' Processes a complete message of the client '''
+
+        try :
+            assert msg_type == self.codec.msg_type, f'Unexpected message type {msg_type}'
+            command = self.codec.decode(payload)
+        except Exception :
+            return self.close()
+
+        if self.hostname is None :
+            self.handshake(command)
+        elif isinstance(command,str) :
+            if command == 'CLOSE_CONNECTION' :
+                self.close()
+            elif command == 'DEVICES_STATUS?' :
+                self.write(devices.get_devices_status())
+        elif isinstance(command,dict) :
+            self.add_request(command)
+
+
+    def handshake(self, command):
 
         ''' Check that incoming connection comes from another Autolab program,
-            and that no thread is already controlling autolab '''
+        and chooses the codec of the messages among those proposed by the client '''
 
-        self.socket.settimeout(2)
+        if not isinstance(command,str) or not command.startswith('AUTOLAB?') : return self.close()
+
+        fields = get_handshake_fields(command)
+        if 'HOSTNAME' not in fields : return self.close()
+        codecs = [name for name in fields.get('CODECS','autolab1').split(',') if name in self.server.codecs]
+        if len(codecs) == 0 :
+            self.write(f"No common codec with the server (available: {','.join(self.server.codecs)})")
+            return self.close()
+
+        self.hostname = fields['HOSTNAME']
+        self.server.log(f'Host "{self.hostname}" connected (codec {codecs[0]})')
+        self.write(f'YES&CODEC={codecs[0]}')
+        self.codec = CODECS[codecs[0]]
+
+
+    def encode(self, answer):
+
+        ''' Returns the answer and the parts of its message. An answer which cannot be
+        encoded is replaced by an error, so that the encoding of the answers can be done
+        by the workers without risk for the event loop '''
 
         try :
-            # Read first command from client
-            handshake_str = self.read()
+            return answer, get_frame_parts(self.codec,answer)
+        except Exception as e :
+            error = {key:answer[key] for key in ['id','stream'] if key in answer}
+            error['error'] = f'{e.__class__.__name__}: The answer cannot be transmitted ({e})'
+            if 'stream' in answer : error.update(time=[],value=[])
+            return error, get_frame_parts(self.codec,error)
 
-            # Check that first client command is 'AUTOLAB?'
-            if handshake_str.startswith('AUTOLAB?') :
 
-                self.hostname = handshake_str.split('=')[1]
+    def write(self, object, parts=None):
 
-                # There is no main thread currently running, accepting communication
-                if self.server.active_connection_thread is None :
-                    self.server.active_connection_thread = self
-                    self.server.log(f'Host "{self.hostname}" connected')
-                    self.write('YES')
-                    result = True
+        ''' Queues an object (or the parts of its message, if already encoded) to be sent to the client '''
 
-                # Another client is controlling autolab, reply that the server is busy, refusing communication
-                else :
-                    self.server.log(f'Host "{self.hostname}" trying to connect but a connection is already established from host "{self.server.active_connection_thread.hostname}"')
-                    self.write(f'A connection to the Autolab server is already established from host "{self.server.active_connection_thread.hostname}".')
-                    result = False
+        if self.closed : return
+        if parts is None : parts = get_frame_parts(self.codec,object)
+        self._output.extend(parts)
+        self._output_size += sum(memoryview(part).nbytes for part in parts)
+        self.on_writable()
 
-            # The client did not ask the right first command, refusing communication
-            else : result = False
 
-        except Exception as e:
-            print(e)
-            result = False
+    def on_writable(self):
 
-        self.socket.settimeout(None)
+        ''' Sends as much queued data as possible, and waits for the socket to be
+        writable again if some remains '''
 
-        return result
+        try :
+            while self._output :
+                data = self._output[0]
+                nbytes = self.socket.send(data)
+                self._output_size -= nbytes
+                if nbytes < len(data) :
+                    self._output[0] = memoryview(data)[nbytes:]
+                    break
+                self._output.popleft()
+        except (BlockingIOError,InterruptedError) :
+            pass
+        except OSError :
+            return self.close()
 
+        if not self._output : # Sends the samples held back while the client was late
+            for subscription in list(self.subscriptions.values()) :
+                if subscription.held : self.send_samples(subscription)
 
-    def listen(self):
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self._output else 0)
+        self.server.selector.modify(self.socket,events,self)
 
-        ''' Listen and answer client commands '''
 
-        while self.stop_flag.is_set() is False :
 
-            try:
-                command = self.read()
-                self.process_command(command)
-            except:
-                self.stop_flag.set()
+    # Requests
+    # =========================================================================
 
+    def add_request(self, request):
 
-    def process_command(self,command):
+        ''' Queues a request of the client, and executes it if possible '''
 
-        ''' Process given client command '''
+        device_name = get_request_device(request)
+        self._queues.setdefault(device_name,collections.deque()).append((next(self._request_numbers),request))
+        self.execute_next()
 
-        if isinstance(command,str) :
-            if command == 'CLOSE_CONNECTION' :
-                self.stop_flag.set()
-            elif command == 'DEVICES_STATUS?' :
-                return self.write(devices.get_devices_status())
+
+    def execute_next(self):
+
+        ''' Executes the requests of this client which can be: the requests on a device are
+        executed one after the other, in their order of arrival, but several devices can be
+        requested at the same time. The requests not related to a single device ('*': batch,
+        devices_status...) wait for all the previous ones, and the next ones wait for them '''
+
+        while not self.closed :
+            barrier = self._queues['*'][0][0] if self._queues.get('*') else None
+            started = False
+            for device_name, queue in list(self._queues.items()) :
+                if device_name in self._running or '*' in self._running or not queue : continue
+                number, request = queue[0]
+                if device_name == '*' :
+                    if self._running or any(other[0][0] < number for other in self._queues.values() if other) : continue
+                elif barrier is not None and number > barrier : continue
+                queue.popleft()
+                if not queue : del self._queues[device_name]
+                self.execute(device_name,request)
+                started = True
+            if not started : return
+
+
+    def execute(self, device_name, request):
+
+        ''' Answers a request processed by the server itself, or sends it to the workers '''
+
+        answer = self.server.check_request(self,request)
+        if answer is not None : # Processed by the server itself (lease, metrics) or refused
+            self.server.record_request(request,answer,0)
+            self.write(answer)
         else :
-            if command['command'] == 'get_device_model' :
-                device_name = command['device_name']
-                structure = devices.get_device(device_name).get_structure()
-                self.write(structure)
-            elif command['command'] == 'request' :
-                devices.get_devices(device_name).get_by_adress(command['element_adress'])
-                # element_address --> my_yenista::submodule::wavelength
-                wavelength()
+            self._running.add(device_name)
+            self.server.executor.submit(self.server.execute,self,request)
 
 
+    def on_answer(self, request, answer, parts, duration):
 
-#command_dict = {'command':'get_driver_model','name':self.name}
+        ''' Sends the answer of an executed request (encoded by the worker) and executes the next one '''
 
-    def close(self):
+        self._running.discard(get_request_device(request))
+        self.server.record_request(request,answer,duration)
+        self.write(answer,parts)
+        self.execute_next()
 
-        # In case the close call come from outside of the threading
-        self.socket.close()
 
-        # If this thread is the main client thread, remove declaration
-        if self.server.active_connection_thread == self :
-            self.server.log(f'Host "{self.hostname}" disconnected')
-            self.server.active_connection_thread = None
+    def send_samples(self, subscription):
+
+        ''' Sends the samples acquired by a subscription, unless the client is late to
+        receive the previous messages: they are then kept (and decimated if needed) by
+        the subscription, and sent once the client has caught up '''
 
+        subscription.queued = False
+        subscription.held = self._output_size > MAX_OUTPUT_SIZE
+        if self.closed or subscription.held : return
+        message = subscription.take_samples()
+        if message is None : return
+        message, parts = self.encode(message)
+        if 'error' in message : # The subscription is stopped
+            subscription.stop()
+            self.subscriptions.pop(subscription.stream_id,None)
+        self.server.metrics['streamed_samples'] += len(message['time'])
+        self.write(message,parts)
 
-    def request_close(self):
 
-        self.stop_flag.set()
-        self.socket.shutdown(socket.SHUT_RDWR)
-        self.join()
+
+    def close(self):
+
+        ''' Closes the connection, stops the subscriptions and releases the leases of the client '''
+
+        if self.closed : return
+        self.closed = True
+        for subscription in list(self.subscriptions.values()) :
+            subscription.stop()
+        try : self.server.selector.unregister(self.socket)
+        except (KeyError,ValueError) : pass
+        self.socket.close()
+        self.server.remove_client(self)
 
 
 
@@ -166,23 +386,40 @@ class ClientThread(threading.Thread,Driver_SOCKET):
 
 class Server():
 
-    def __init__(self,port=None):
+    ''' Autolab server: several clients can read the devices at the same time. A client
+    can take an exclusive write lease on a device: the other clients can then still read
+    it, but not write its variables or execute its actions until the lease is released.
+    A client can also subscribe to a variable: the server reads it at the requested rate
+    and pushes the timestamped samples to the client in batches (see Subscription) '''
+
+    def __init__(self,port=None,workers=8,codecs=('autolab1',)):
+
+        # Codecs accepted for the messages. The pickle codec can execute code at decoding,
+        # it should only be added for trusted clients
+        for name in codecs : assert name in CODECS, f"Unknown codec {name} (available: {','.join(CODECS)})"
+        self.codecs = list(codecs)
+
+        self.clients = []
+        self.leases = {} # {device_name: client}
 
-        self.client_threads = []
-        self.active_connection_thread = None
+        # Statistics of the connections and of the requests
+        self.metrics = {'connections':0,'active_connections':0,'requests':0,'errors':0,
+                        'commands':collections.Counter(),'total_time':0.,'max_time':0.,
+                        'streamed_samples':0}
 
         # Load server config in autolab_config.ini
         server_config = config.get_server_config()
         if not port: port = int(server_config['port'])
         self.port = port
+        self.workers = int(workers)
 
         # Start the server
         self.start()
 
         # Start listening
         try : self.listen()
-        except : print('You excited the server (TO CHANGE)')
-        self.close()
+        except KeyboardInterrupt : self.log('Autolab server stopped')
+        finally : self.close()
 
 
     def start(self):
@@ -192,42 +429,217 @@ class Server():
         self.main_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.main_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.main_socket.bind(('', self.port))
-        self.main_socket.listen(0)
+        self.main_socket.listen(64)
+        self.main_socket.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.main_socket,selectors.EVENT_READ,None)
+
+        # The answers of the workers and the samples of the subscriptions are sent back
+        # to the event loop through queues, and a socket pair to wake it up
+        self.answers = queue.Queue()
+        self.streams = queue.Queue()
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.selector.register(self.wakeup_receiver,selectors.EVENT_READ,'wakeup')
+        self.executor = ThreadPoolExecutor(max_workers=self.workers,thread_name_prefix='autolab-server')
+
         self.log(f'Autolab server running, waiting for incoming connections on port {self.port}')
 
 
     def listen(self):
 
+        ''' Event loop of the server '''
+
         while True :
 
-            # Wait incoming connection
-            client_socket, _ = self.main_socket.accept()
+            for key, events in self.selector.select(timeout=1) :
+                if key.data is None :
+                    self.accept()
+                elif key.data == 'wakeup' :
+                    self.process_answers()
+                else :
+                    self.process_events(key.data,events)
+
+            # Clients which did not handshake in time
+            for client in list(self.clients) :
+                if client.hostname is None and time.monotonic()-client.connection_time > 2 :
+                    client.close()
+
+
+    def process_events(self,client,events):
+
+        ''' Receives and sends the data of a client '''
+
+        if events & selectors.EVENT_READ : self.call_client(client,client.on_readable)
+        if events & selectors.EVENT_WRITE and not client.closed : self.call_client(client,client.on_writable)
+
+
+    def call_client(self,client,function,*args):
+
+        ''' Calls a method of a client in the event loop: an error only closes this client '''
+
+        try :
+            function(*args)
+        except Exception as e :
+            self.log(f'Error with host "{client.hostname}", connection closed: {e.__class__.__name__}: {e}')
+            client.close()
+
+
+    def accept(self):
+
+        ''' Accepts an incoming connection '''
+
+        try : client_socket, _ = self.main_socket.accept()
+        except (BlockingIOError,InterruptedError) : return
+        client = ClientConnection(client_socket,self)
+        self.clients.append(client)
+        self.selector.register(client_socket,selectors.EVENT_READ,client)
+        self.metrics['connections'] += 1
+        self.metrics['active_connections'] = len(self.clients)
+
+
+    def remove_client(self,client):
+
+        ''' Forgets a closed client, and releases its leases '''
+
+        if client in self.clients : self.clients.remove(client)
+        for device_name in [name for name,holder in self.leases.items() if holder is client] :
+            del self.leases[device_name]
+        self.metrics['active_connections'] = len(self.clients)
+        if client.hostname is not None : self.log(f'Host "{client.hostname}" disconnected')
+
+
+
+    # Requests
+    # =========================================================================
+
+    def check_request(self,client,request):
+
+        ''' Processes the requests handled by the server itself (leases, metrics), and
+        refuses the writes on devices leased by another client. Returns the answer in
+        these cases, None if the request has to be executed '''
+
+        command = request.get('command')
+        answer = {'id':request.get('id')}
+
+        if command in ['lease','release'] :
+            device_name = request.get('device_name')
+            holder = self.leases.get(device_name)
+            if holder is not None and holder is not client :
+                answer['error'] = f'LeaseError: Device {device_name} is leased by host "{holder.hostname}"'
+            elif command == 'lease' :
+                self.leases[device_name] = client
+                answer['result'] = True
+            else :
+                self.leases.pop(device_name,None)
+                answer['result'] = True
+            return answer
+
+        if command == 'server_metrics' :
+            answer['result'] = self.get_metrics()
+            return answer
+
+        if command == 'unsubscribe' :
+            subscription = client.subscriptions.pop(request.get('stream'),None)
+            if subscription is not None : subscription.stop()
+            answer['result'] = subscription is not None
+            return answer
+
+        # Writes are refused on the devices leased by another client
+        for sub_request in get_sub_requests(request) :
+            if sub_request.get('command') in ['write','execute'] :
+                device_name = str(sub_request.get('address','')).split('.')[0]
+                holder = self.leases.get(device_name)
+                if holder is not None and holder is not client :
+                    answer['error'] = f'LeaseError: Device {device_name} is leased by host "{holder.hostname}"'
+                    return answer
+
+
+    def execute(self,client,request):
+
+        ''' Executes a request in a worker thread, and transmits the answer to the event loop '''
+
+        start = time.perf_counter()
+        if request.get('command') == 'subscribe' : answer = self.subscribe(client,request)
+        else : answer = execute_request(request)
+        answer, parts = client.encode(answer)
+        self.answers.put((client,request,answer,parts,time.perf_counter()-start))
+        self.wakeup_sender.send(b'\0')
+
+
+    def subscribe(self,client,request):
+
+        ''' Starts the acquisition loop of a variable for a client. Executed by a worker,
+        as the device may have to be loaded '''
+
+        answer = {'id':request.get('id')}
+
+        try :
+            variable = devices.get_element_by_address(request['address'])
+            assert variable._element_type == 'variable' and variable.readable, f"The element {request['address']} is not a readable variable"
+            stream_id = request['stream']
+            assert stream_id not in client.subscriptions, f'Stream {stream_id} already used'
+            subscription = Subscription(self,client,stream_id,variable,rate=request.get('rate',10),
+                                        batch_interval=request.get('batch_interval',0.1),
+                                        max_samples=request.get('max_samples',10000))
+            client.subscriptions[stream_id] = subscription
+            subscription.start()
+            answer['result'] = stream_id
+        except Exception as e :
+            answer['error'] = f'{e.__class__.__name__}: {e}'
+
+        return answer
+
+
+    def push(self,subscription):
 
-            # Clean terminated threads
-            self.clean_client_threads()
+        ''' Asks the event loop to send the samples of a subscription to its client '''
 
-            # Start new client thread
-            client_thread = ClientThread(client_socket,self)
-            client_thread.start()
-            self.client_threads.append(client_thread)
+        self.streams.put(subscription)
+        self.wakeup_sender.send(b'\0')
 
 
-    def clean_client_threads(self):
+    def process_answers(self):
 
-        ''' Remove finshed client threads from the list '''
+        ''' Sends the answers of the executed requests and the samples of the subscriptions
+        to their clients '''
 
-        self.client_threads = [t for t in self.client_threads if t.is_alive()]
+        try :
+            while self.wakeup_receiver.recv(4096) : pass
+        except (BlockingIOError,InterruptedError) :
+            pass
+        while not self.answers.empty() :
+            client, request, answer, parts, duration = self.answers.get()
+            self.call_client(client,client.on_answer,request,answer,parts,duration)
+        while not self.streams.empty() :
+            subscription = self.streams.get()
+            self.call_client(subscription.client,subscription.client.send_samples,subscription)
+
+
+    def record_request(self,request,answer,duration):
 
-    def close_client_threads(self):
+        ''' Updates the statistics of the requests '''
 
-        ''' Close any existing client thread '''
+        self.metrics['requests'] += 1
+        self.metrics['commands'][str(request.get('command'))] += 1
+        if 'error' in answer : self.metrics['errors'] += 1
+        self.metrics['total_time'] += duration
+        self.metrics['max_time'] = max(self.metrics['max_time'],duration)
 
-        self.clean_client_threads()
 
-        for thread in self.client_threads :
-            thread.request_close()
+    def get_metrics(self):
 
-        self.client_threads = []
+        ''' Returns the statistics of the connections and of the requests of the server '''
+
+        metrics = dict(self.metrics,commands=dict(self.metrics['commands']))
+        metrics['mean_time'] = metrics['total_time']/metrics['requests'] if metrics['requests'] > 0 else 0.
+        metrics['clients'] = [client.hostname for client in self.clients]
+        metrics['leases'] = {name:client.hostname for name,client in self.leases.items()}
+        metrics['subscriptions'] = {f'{client.hostname}:{stream_id}':subscription.get_status()
+                                    for client in self.clients
+                                    for stream_id,subscription in list(client.subscriptions.items())}
+        return metrics
 
 
     def log(self,log):
@@ -240,10 +652,14 @@ class Server():
 
     def close(self):
 
-        ''' Close the server and client threads'''
+        ''' Close the server and the client connections '''
 
-        self.close_client_threads()
-        self.main_socket.shutdown(socket.SHUT_RDWR)
+        for client in list(self.clients) :
+            client.close()
+        self.executor.shutdown(wait=False)
+        self.selector.close()
+        self.wakeup_receiver.close()
+        self.wakeup_sender.close()
         self.main_socket.close()
 
 
@@ -251,23 +667,273 @@ class Server():
 
 
 
+class Subscription():
+
+    ''' Acquisition loop of a variable for a client: a thread of the server reads the
+    variable at the requested rate (Hz), and the timestamped samples are pushed to the
+    client every batch_interval seconds. If the client does not receive them fast enough
+    (slow link), the samples accumulate on the server: above max_samples, one sample out
+    of two is dropped and only one acquisition out of decimation is kept. The decimation
+    is relaxed each time a batch could be sent '''
+
+    def __init__(self,server,client,stream_id,variable,rate=10,batch_interval=0.1,max_samples=10000):
+
+        assert float(rate) > 0, f'The rate of a subscription must be positive (got {rate})'
+
+        self.server = server
+        self.client = client
+        self.stream_id = stream_id
+        self.variable = variable
+        self.period = 1/float(rate)
+        self.batch_interval = float(batch_interval)
+        self.max_samples = max(int(max_samples),2)
+
+        self.decimation = 1
+        self.acquisitions = 0
+        self.error = None
+        self.queued = False # Waiting to be sent by the event loop
+        self.held = False # Not sent because the client is late
+
+        self._times = []
+        self._values = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run,daemon=True,
+                                        name=f'autolab-subscription-{variable.address()}')
+
+
+    def start(self):
+
+        self._thread.start()
+
+
+    def stop(self):
+
+        self._stop.set()
+
+
+    def run(self):
+
+        ''' Acquisition loop, without drift: a late acquisition delays the next ones
+        instead of being followed by a burst '''
+
+        next_time = time.monotonic()
+        flush_time = next_time + self.batch_interval
+
+        while not self._stop.is_set() and not self.client.closed :
+
+            try :
+                value = self.variable()
+            except Exception as e :
+                self.error = f'{e.__class__.__name__}: {e}'
+                self.flush()
+                break
+            self.add_sample(time.time(),value)
+
+            now = time.monotonic()
+            if now >= flush_time :
+                self.flush()
+                flush_time = now + self.batch_interval
+            next_time = max(next_time+self.period,now)
+            self._stop.wait(next_time-now)
+
+
+    def add_sample(self,timestamp,value):
+
+        with self._lock :
+            self.acquisitions += 1
+            if self.acquisitions % self.decimation != 0 : return
+            self._times.append(timestamp)
+            self._values.append(value)
+            if len(self._times) > self.max_samples : # The client does not follow
+                del self._times[::2]
+                del self._values[::2]
+                self.decimation *= 2
+
+
+    def flush(self):
+
+        ''' Asks the event loop to send the samples acquired '''
+
+        with self._lock :
+            if self.queued or self._stop.is_set() : return
+            self.queued = True
+        try : self.server.push(self)
+        except OSError : pass # Server closed
+
+
+    def take_samples(self):
+
+        ''' Returns the message transmitting the samples acquired since the previous one
+        {'stream', 'time', 'value', 'decimation'(, 'error')}, None if there are none.
+        The numerical values are sent as a numpy array '''
+
+        import numpy as np
+
+        with self._lock :
+            if len(self._times) == 0 and self.error is None : return None
+            times, self._times = self._times, []
+            values, self._values = self._values, []
+            decimation = self.decimation
+            self.decimation = max(self.decimation//2,1) # The client has caught up
+
+        message = {'stream':self.stream_id,'time':np.array(times,dtype=float),'decimation':decimation}
+        if self.variable.type in [int,float,bool] : message['value'] = np.array(values,dtype=self.variable.type)
+        else : message['value'] = values
+        if self.error is not None :
+            message['error'] = self.error
+            self.client.subscriptions.pop(self.stream_id,None)
+        return message
+
+
+    def get_status(self):
+
+        return {'address':self.variable.address(),'rate':1/self.period,'decimation':self.decimation,
+                'acquisitions':self.acquisitions,'pending_samples':len(self._times)}
+
+
+
+
+
+
+def execute_request(request):
+
+    ''' Executes a request of a client and returns the answer {'id':..., 'result':...},
+    or {'id':..., 'error':...} if it failed '''
+
+    answer = {'id':request.get('id')}
+
+    try :
+        command = request['command']
+
+        if command == 'batch' :
+            answer['result'] = [execute_request(sub_request) for sub_request in request['requests']]
+
+        elif command == 'devices_status' :
+            answer['result'] = devices.get_devices_status()
+
+        elif command == 'get_device_model' :
+            answer['result'] = devices.get_device(request['device_name']).get_structure()
+
+        elif command == 'get_model' :
+            answer['result'] = get_module_description(devices.get_element_by_address(request['address']))
+
+        elif command in ['read','write','execute'] :
+            element = devices.get_element_by_address(request['address'])
+            expected_type = {'read':'variable','write':'variable','execute':'action'}[command]
+            assert element._element_type == expected_type, f"The element {request['address']} is not a {expected_type}"
+            if command == 'read' : answer['result'] = element()
+            else : answer['result'] = element(request.get('value'))
+
+        else :
+            raise ValueError(f"Unknown command '{command}'")
+
+    except Exception as e :
+        answer['error'] = f'{e.__class__.__name__}: {e}'
+
+    return answer
+
+
+
+def get_request_device(request):
+
+    ''' Returns the name of the device concerned by a request, '*' if it is not related
+    to a single device '''
+
+    if request.get('command') in ['read','write','execute','subscribe','get_model'] :
+        return str(request.get('address','')).split('.')[0]
+    if request.get('command') in ['get_device_model','lease','release'] :
+        return str(request.get('device_name'))
+    return '*'
+
+
+
+def get_sub_requests(request):
+
+    ''' Returns the requests executed by a request: itself, or those of a batch, including
+    the nested batches '''
+
+    if request.get('command') != 'batch' : return [request]
+    sub_requests = []
+    requests = request.get('requests')
+    if not isinstance(requests,(list,tuple)) : return sub_requests # Refused by execute_request
+    for sub_request in requests :
+        if isinstance(sub_request,dict) : sub_requests.extend(get_sub_requests(sub_request))
+    return sub_requests
+
+
+
+def get_module_description(module):
+
+    ''' Returns the description of the elements of a module (without their content for
+    the submodules), used by the clients to build a proxy of the module '''
+
+    assert module._element_type == 'module', f"The element {module.address()} is not a module"
+
+    description = []
+    for name in module.list_modules() :
+        # The submodules not yet constructed are not constructed to read their help
+        if module._mod[name] is None : module_help = module._mod_configs[name].get('help')
+        else : module_help = module._mod[name]._help
+        description.append({'element':'module','name':name,'help':module_help})
+    for name in module.list_variables() :
+        variable = module.get_variable(name)
+        description.append({'element':'variable','name':name,'help':variable._help,
+                            'type':variable.type,'unit':variable.unit,
+                            'readable':variable.readable,'writable':variable.writable})
+    for name in module.list_actions() :
+        action = module.get_action(name)
+        description.append({'element':'action','name':name,'help':action._help,
+                            'type':action.type,'unit':action.unit})
+    return description
+
+
+
+
+
+
+class RemoteError(Exception):
+
+    ''' Error raised by a request on the autolab server '''
+
+
+
+
+
 class Driver_REMOTE(Driver_SOCKET):
 
-    def __init__(self,address='192.168.1.1',port=4001):
-        from functools import partial
+    ''' Driver of a remote autolab server: each device of the server is a module of this driver '''
+
+    def __init__(self,address='192.168.1.1',port=4001,timeout=None,codec='autolab1'):
 
         self.address = address
         self.port    = int(port)
+        self.timeout = float(timeout) if timeout not in [None,'None',''] else None
+        assert codec in CODECS, f"Unknown codec {codec} (available: {','.join(CODECS)})"
+        self.requested_codec = codec
+
+        # Requests waiting for their answers {id: Future}
+        self._pending = {}
+        self._request_ids = itertools.count()
 
-        # Connection au serveur Autolab
+        # Variables streamed by the server {stream_id: RemoteSubscription}
+        self._streams = {}
+        self._stream_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._error = None
+
+        # Connection to the autolab server
         self.connect()
 
         # Handshaking
         self.handshake()
 
-        # Retourne la liste des devices
+        # Thread receiving the answers of the server
+        self._receiver = threading.Thread(target=self.receive_answers,daemon=True)
+        self._receiver.start()
+
+        # List of the devices of the server
         self.devices_status = self.get_devices_status()
-        print(self.devices_status)
 
 
     def connect(self):
@@ -278,96 +944,315 @@ class Driver_REMOTE(Driver_SOCKET):
         self.socket.settimeout(2)
         self.socket.connect((self.address, self.port))
         self.socket.settimeout(None)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
 
     def handshake(self):
 
         ''' Check that distant partner is an Autolab server '''
 
-        self.write(f'AUTOLAB?HOSTNAME={socket.gethostname()}')
+        self.write(f'AUTOLAB?HOSTNAME={socket.gethostname()}&CODECS={self.requested_codec}')
         try :
             answer = self.read()
-            assert answer == 'YES', answer
+            assert isinstance(answer,str) and answer.startswith('YES'), answer
+            self.codec = CODECS[get_handshake_fields(answer).get('CODEC','autolab1')]
         except Exception as e :
             raise ValueError(f'Impossible to join autolab server at {self.address}:{self.port} \n {e}')
 
 
+    def receive_answers(self):
+
+        ''' Receives the answers of the server and transmits them to the pending requests '''
+
+        try :
+            while True :
+                answer = self.read()
+                if 'stream' in answer : # Samples pushed by a subscription
+                    subscription = self._streams.get(answer['stream'])
+                    if subscription is not None : subscription.on_samples(answer)
+                    continue
+                with self._lock :
+                    future = self._pending.pop(answer['id'],None)
+                if future is None : continue
+                if 'error' in answer : future.set_exception(RemoteError(answer['error']))
+                else : future.set_result(answer['result'])
+
+        except Exception as e :
+            with self._lock :
+                self._error = ConnectionError(f'Connection to autolab server at {self.address}:{self.port} lost ({e})')
+                pending, self._pending = self._pending, {}
+            for future in pending.values() :
+                future.set_exception(self._error)
+            for subscription in list(self._streams.values()) :
+                subscription.on_samples({'time':[],'value':[],'error':str(self._error)})
+
+
+    def submit(self,command,**kwargs):
+
+        ''' Sends a request to the server without waiting for its answer, and returns
+        a Future. Several requests can be in flight at the same time. '''
+
+        future = Future()
+        with self._lock :
+            if self._error is not None : raise self._error
+            request_id = next(self._request_ids)
+            self._pending[request_id] = future
+            future.request_id = request_id
+            self.write(dict(kwargs,id=request_id,command=command))
+        return future
+
+
+    def request(self,command,**kwargs):
+
+        ''' Sends a request to the server and returns its result '''
+
+        future = self.submit(command,**kwargs)
+        try :
+            return future.result(self.timeout)
+        except FutureTimeoutError :
+            with self._lock : # The answer, if it ever comes, is ignored
+                self._pending.pop(future.request_id,None)
+            raise
+
+
+    def batch(self,requests):
+
+        ''' Executes a list of requests {'command':..., arguments} in a single round-trip.
+        Returns the list of their results, with a RemoteError for those which failed '''
+
+        answers = self.request('batch',requests=list(requests))
+        return [RemoteError(answer['error']) if 'error' in answer else answer['result']
+                for answer in answers]
+
+
     def disconnect(self):
 
         ''' Close autolab server connection '''
 
-        self.socket.write('CLOSE_CONNECTION')
-        self.socket.shutdown(socket.SHUT_RDWR)
+        try : self.write('CLOSE_CONNECTION')
+        except OSError : pass
+        try : self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError : pass
         self.socket.close()
 
 
+    def close(self):
+
+        self.disconnect()
+
+
+    def lease(self,device_name):
+
+        ''' Takes the exclusive write lease of a device of the server: the other clients
+        can still read it, but not write it until the lease is released '''
+
+        self.request('lease',device_name=device_name)
+
+
+    def release(self,device_name):
+
+        ''' Releases the write lease of a device of the server '''
+
+        self.request('release',device_name=device_name)
+
+
+    def subscribe(self,address,rate=10,callback=None,batch_interval=0.1,max_samples=10000):
+
+        ''' Streams the values of a variable of the server: the server reads it at rate (Hz)
+        and pushes the timestamped samples every batch_interval seconds, instead of one
+        round-trip per read. The samples are passed to callback(times, values) in the
+        receiving thread if provided, otherwise they are kept by the returned
+        RemoteSubscription until retrieved with its method samples.
+        If the link is too slow, the server decimates the samples (at most max_samples
+        are kept waiting) '''
+
+        subscription = RemoteSubscription(self,address,callback=callback,max_samples=max_samples)
+        subscription.stream_id = next(self._stream_ids)
+        self._streams[subscription.stream_id] = subscription
+        try :
+            self.request('subscribe',address=address,stream=subscription.stream_id,rate=rate,
+                         batch_interval=batch_interval,max_samples=max_samples)
+        except Exception :
+            del self._streams[subscription.stream_id]
+            raise
+        return subscription
+
+
+    def unsubscribe(self,subscription):
+
+        ''' Stops a subscription '''
+
+        self._streams.pop(subscription.stream_id,None)
+        if self._error is None : self.request('unsubscribe',stream=subscription.stream_id)
+
+
+    def server_metrics(self):
+
+        ''' Returns the statistics of the connections and of the requests of the server '''
+
+        return self.request('server_metrics')
+
+
     def get_devices_status(self) : # Déjà instantié ou non
-        self.write('DEVICES_STATUS?')
-        return self.read()
+
+        return self.request('devices_status')
 
 
     def get_driver_model(self):
+
         model = []
-        for dev_name in self.devices_status.keys() :
-            a = FakeDriver(self,dev_name,status)
-            model.append({'element':'module', 'name':dev_name, 'object': a})
-            a.get_driver_model()
-            partial(devices.Device,dev_name)
+        for dev_name,loaded in self.devices_status.items() :
+            # Each device of the server has its own lock: a slow device does not block the others
+            model.append({'element':'module','name':dev_name,'object':RemoteModule(self,dev_name),
+                          'help':f'Device {dev_name} of the autolab server {self.address}',
+                          'independent':True})
         return model
 
 
-    def get_device(self,dev_name):
-        pass
 
-    def get_device_structure(self):
-        pass
-            # Pour un device de slave donné, retourne sa structure de (sous-devices, modules, action variable) à l’instant t
-            # Device non instantité : ne renvoie rien
-            # Device instantié : renvoie structure en (modules, action, variable)
 
-class FakeDriver():
 
-    def __init__(self,driver_remote,name,status) :
+
+class RemoteSubscription():
+
+    ''' Stream of the samples of a variable of the server (see Driver_REMOTE.subscribe) '''
+
+    def __init__(self,driver_remote,address,callback=None,max_samples=10000) :
+
+        self.driver_remote = driver_remote
+        self.address = address
+        self.callback = callback
+        self.stream_id = None
+        self.decimation = 1 # One acquisition out of decimation received
+        self.error = None
+
+        # Samples not yet retrieved (the oldest are dropped above max_samples)
+        self._times = collections.deque(maxlen=int(max_samples))
+        self._values = collections.deque(maxlen=int(max_samples))
+        self._lock = threading.Lock()
+
+
+    def on_samples(self,message):
+
+        ''' Receives a batch of samples pushed by the server '''
+
+        self.decimation = message.get('decimation',self.decimation)
+        if 'error' in message :
+            self.error = RemoteError(message['error'])
+            self.driver_remote._streams.pop(self.stream_id,None)
+        if len(message['time']) == 0 : return
+
+        if self.callback is not None :
+            self.callback(message['time'],message['value'])
+        else :
+            with self._lock :
+                self._times.extend(message['time'])
+                self._values.extend(message['value'])
+
+
+    def samples(self):
+
+        ''' Returns the samples received since the previous call: (times, values), with
+        the timestamps of the acquisitions on the server (s, numpy array). Raises the
+        error which stopped the subscription once all the samples are retrieved '''
+
+        import numpy as np
+
+        with self._lock :
+            times, values = np.array(self._times,dtype=float), list(self._values)
+            self._times.clear()
+            self._values.clear()
+        if len(times) == 0 and self.error is not None : raise self.error
+        return times, values
+
+
+    def close(self):
+
+        self.driver_remote.unsubscribe(self)
+
+
+
+
+
+
+class RemoteModule():
+
+    ''' Proxy of a module of a remote device. Its description is requested to the server
+    when the module is constructed, i.e. at its first access '''
+
+    def __init__(self,driver_remote,address) :
 
         self.driver_remote = driver_remote
-        self.name = name
-        self.status = status
+        self.address = address
+
+
+    def bulk_query(self,queries):
+
+        ''' Reads several variables of this module in a single round-trip (see Module.read_bulk) '''
+
+        answers = self.driver_remote.batch([{'command':'read','address':address} for address in queries])
+        for answer in answers :
+            if isinstance(answer,Exception) : raise answer
+        return answers
 
 
     def get_driver_model(self) :
+
         model = []
-        if status is False :
-            return model
-        else:
-            command_dict = {'command':'get_device_structure','name':self.name}
-            remote_device_structure = self.driver_remote.write(command_dict)
+        for description in self.driver_remote.request('get_model',address=self.address) :
+
+            address = f"{self.address}.{description['name']}"
+            config = {'element':description['element'],'name':description['name']}
+            if description['help'] is not None : config['help'] = description['help']
+
+            if description['element'] == 'module' :
+                config['object'] = RemoteModule(self.driver_remote,address)
+
+            elif description['element'] == 'variable' :
+                element = RemoteElement(self.driver_remote,address)
+                config['type'] = description['type']
+                if description['unit'] is not None : config['unit'] = description['unit']
+                if description['readable'] : config['read'] = element.read
+                if description['writable'] : config['write'] = element.write
+                if description['readable'] and description['type'] in [int,float,bool,str] :
+                    config['query'] = address # Allows batch reads
+
+            elif description['element'] == 'action' :
+                element = RemoteElement(self.driver_remote,address)
+                config['do'] = element.do
+                if description['type'] is not None :
+                    config['param_type'] = description['type']
+                    if description['unit'] is not None : config['param_unit'] = description['unit']
+
+            model.append(config)
+
+        return model
+
 
-            for key in remote_device_structure.keys() :
-                if remote_device_structure[key] == 'variable' :
-                    arg = {'command':'request',address:'yenista::wavelength'}
-                    #model.append({'element':remote_device_structure[key], 'name':key, 'read': partial(self.interact,'read',address) .., 'write'})
-                elif remote_device_structure[key] == 'action' :
-                    pass
-                elif remote_device_structure[key] == 'module' :
-                    pass
 
-            return remote_driver_model
 
 
-    def interact(interaction_type,address):
 
-        pass
+class RemoteElement():
+
+    ''' Proxy of a variable or an action of a remote device '''
+
+    def __init__(self,driver_remote,address) :
+
+        self.driver_remote = driver_remote
+        self.address = address
+
+
+    def read(self):
+
+        return self.driver_remote.request('read',address=self.address)
+
 
+    def write(self,value):
 
-#{'slot1': {'power': 'variable', 'wavelength': 'variable'},
-# 'amplitude': 'variable',
-# 'something': 'action'}
+        self.driver_remote.request('write',address=self.address,value=value)
 
-#def get_driver_model(self):
 
- #    model = []
-#    model.append({'element':'variable','name':'amplitude','write':self.amplitude,'read':self.get_amplitude,'unit':'V','type':float,'help':'Amplitude'})
-#    model.append({'element':'variable','name':'offset','write':self.offset,'read':self.get_offset,'unit':'V','type':float,'help':'Offset'})
-#    model.append({'element':'variable','name':'frequency','write':self.frequency,'read':self.get_frequency,'unit':'Hz','type':float,'help':'Frequency'})
+    def do(self,value=None):
 
-#    return model
+        self.driver_remote.request('execute',address=self.address,value=value)
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Shared TCP connections to the instruments, with keepalive and automatic reconnection
+"""
+
+import select
+import socket
+import threading
+import time
+
+
+# Shared connections {(address, port): SocketTransport}
+TRANSPORTS = {}
+TRANSPORTS_LOCK = threading.Lock()
+
+
+
+def get_transport(address, port, **options):
+
+    ''' Returns the TCP connection to address:port, shared with the other drivers
+    using the same instrument (connection pool). It is really closed when all
+    of them have closed it. The options are those of SocketTransport, and can
+    be provided as strings (from devices_config.ini) '''
+
+    key = (address,int(port))
+
+    with TRANSPORTS_LOCK :
+        transport = TRANSPORTS.get(key)
+        if transport is None :
+            transport = SocketTransport(address,port,**options)
+            TRANSPORTS[key] = transport
+        else :
+            transport.users += 1
+        return transport
+
+
+
+def to_bool(value):
+
+    ''' Converts a boolean option, possibly provided as a string '''
+
+    if isinstance(value,str) : return value.strip().lower() not in ['0','false','no','off']
+    return bool(value)
+
+
+
+
+
+class SocketTransport :
+
+    ''' TCP connection to an instrument, with TCP keepalive, timeouts, and automatic
+    reconnection with exponential back-off when the link is broken.
+
+    - timeout : timeout of the connection and of each socket operation (s), None to block
+    - keepalive : enables TCP keepalive, to detect dead links while idle
+    - retries : number of reconnection attempts before raising the error
+    - backoff : delay before the first reconnection attempt (s), doubled at each attempt
+    - backoff_max : maximal delay between two reconnection attempts (s)
+    - on_connect : function called with the transport after each (re)connection,
+      for instance to authenticate or to configure the instrument again '''
+
+    def __init__(self, address, port, timeout=10, keepalive=True, retries=3,
+                 backoff=0.5, backoff_max=10, on_connect=None):
+
+        self.address = address
+        self.port = int(port)
+        self.timeout = float(timeout) if timeout not in [None,'None',''] else None
+        self.keepalive = to_bool(keepalive)
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.backoff_max = float(backoff_max)
+        self.on_connect = on_connect
+
+        self.users = 1
+        self.reconnections = 0
+        self.sock = None
+        self._buffer = bytearray()
+        self._lock = threading.RLock() # One exchange at a time on the connection
+
+        self.connect()
+
+
+
+    # Connection
+    # =========================================================================
+
+    def connect(self):
+
+        ''' Opens the connection (and calls on_connect) '''
+
+        with self._lock :
+            self.sock = socket.create_connection((self.address,self.port),timeout=self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            if self.keepalive : self._set_keepalive()
+            self._buffer = bytearray()
+            if self.on_connect is not None : self.on_connect(self)
+
+
+
+    def _set_keepalive(self, idle=30, interval=10, count=3):
+
+        ''' Enables TCP keepalive: a dead link is detected after idle+interval*count seconds '''
+
+        self.sock.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1)
+        for option,value in [('TCP_KEEPIDLE',idle),('TCP_KEEPINTVL',interval),('TCP_KEEPCNT',count)] :
+            if hasattr(socket,option) : # Not available on every platform
+                self.sock.setsockopt(socket.IPPROTO_TCP,getattr(socket,option),value)
+
+
+
+    def reconnect(self):
+
+        ''' Closes the broken connection and opens a new one, waiting longer and
+        longer between the attempts. Raises the last error if all attempts failed '''
+
+        with self._lock :
+            self._close_socket()
+            delay = self.backoff
+            for attempt in range(self.retries) :
+                time.sleep(delay)
+                try :
+                    self.connect()
+                    self.reconnections += 1
+                    return
+                except OSError as error :
+                    self._close_socket()
+                    last_error = error
+                    delay = min(2*delay,self.backoff_max)
+            if self.retries == 0 : raise ConnectionError(f'Connection to {self.address}:{self.port} lost')
+            raise last_error
+
+
+
+    def _close_socket(self):
+
+        if self.sock is not None :
+            try : self.sock.close()
+            except OSError : pass
+        self.sock = None
+
+
+
+    def close(self):
+
+        ''' Releases the connection, closed when no more driver uses it '''
+
+        with TRANSPORTS_LOCK :
+            self.users -= 1
+            if self.users > 0 : return
+            if TRANSPORTS.get((self.address,self.port)) is self :
+                del TRANSPORTS[(self.address,self.port)]
+        with self._lock :
+            self._close_socket()
+
+
+
+    # Communication
+    # =========================================================================
+
+    def _send_command(self, data):
+
+        ''' Sends data, reconnecting and sending it again if the connection is found
+        broken before or while sending it '''
+
+        try :
+            if self.sock is None or self._closed_by_peer() :
+                raise ConnectionError(f'Connection to {self.address}:{self.port} closed')
+            self._send(data)
+        except socket.timeout :
+            self._close_socket()
+            raise
+        except ConnectionError : # Broken pipe, reset, aborted, refused, or closed by the instrument
+            self.reconnect()
+            self._send(data)
+
+
+
+    def _closed_by_peer(self):
+
+        ''' Returns True if the instrument closed the connection while it was idle '''
+
+        if not select.select([self.sock],[],[],0)[0] : return False
+        return self.sock.recv(1,socket.MSG_PEEK) == b'' # Raises ConnectionResetError if reset
+
+
+
+    def _receive(self, function, *args):
+
+        ''' Returns function(*args) receiving an answer. The instrument may have executed
+        the command: it is never sent again. After a timeout, the connection is closed
+        and opened again at the next exchange, so that the late answer is not read as
+        the answer of the next request. A broken connection is opened again before the
+        error is raised '''
+
+        try :
+            if self.sock is None : raise ConnectionError(f'Connection to {self.address}:{self.port} closed')
+            return function(*args)
+        except socket.timeout : # Same class as TimeoutError since python 3.10
+            self._close_socket()
+            raise
+        except ConnectionError :
+            self.reconnect()
+            raise
+
+
+
+    def _send(self, data):
+
+        self.sock.sendall(data)
+
+
+
+    def _recv(self, length):
+
+        if self._buffer :
+            data = bytes(self._buffer[:length])
+            del self._buffer[:length]
+            return data
+        data = self.sock.recv(length)
+        if data == b'' : raise ConnectionError(f'Connection closed by {self.address}:{self.port}')
+        return data
+
+
+
+    def _read_until(self, terminator, length):
+
+        index = self._buffer.find(terminator)
+        while index < 0 :
+            start = max(len(self._buffer)-len(terminator)+1,0) # Only the new data is searched
+            data = self.sock.recv(length)
+            if data == b'' : raise ConnectionError(f'Connection closed by {self.address}:{self.port}')
+            self._buffer += data
+            index = self._buffer.find(terminator,start)
+        index += len(terminator)
+        data = bytes(self._buffer[:index])
+        del self._buffer[:index]
+        return data
+
+
+
+    def write(self, data):
+
+        ''' Sends data (bytes) to the instrument '''
+
+        with self._lock :
+            self._send_command(data)
+
+
+
+    def read(self, length=4096):
+
+        ''' Returns the data available (at most length bytes), waiting for some if needed '''
+
+        with self._lock :
+            return self._receive(self._recv,length)
+
+
+
+    def read_until(self, terminator=b'\n', length=4096):
+
+        ''' Returns the data received up to terminator (included) '''
+
+        with self._lock :
+            return self._receive(self._read_until,terminator,length)
+
+
+
+    def query(self, data, terminator=b'\n', length=4096):
+
+        ''' Sends data and returns the answer, up to terminator (included) or as it comes
+        if terminator is None. The command is sent again only if the connection was
+        found broken before the instrument could receive it '''
+
+        with self._lock :
+            self._buffer.clear() # Answers of previous requests are obsolete
+            self._send_command(data)
+            if terminator is None : return self._receive(self._recv,length)
+            return self._receive(self._read_until,terminator,length)
@@ -5,10 +5,10 @@ Created on Fri Sep 20 17:11:57 2019
 @author: qchat
 """
 
-import webbrowser
-
 def community():
+    import webbrowser
     webbrowser.open('https://autolab-community.org')
 
 def doc():
+    import webbrowser
     webbrowser.open('https://autolab.readthedocs.io')
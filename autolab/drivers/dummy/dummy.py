@@ -160,8 +160,14 @@ class Slot() :
         if self.dev.verbose : print(f'slot {self.num} get wavelength',value)
         return value
 
+    def bulk_query(self,queries):
+        time.sleep(self.dev.sleep) # Single round-trip for all the queries
+        answers = {'POW?':np.random.uniform,'WAV?':np.random.uniform}
+        if self.dev.verbose : print(f'slot {self.num} bulk query',';'.join(queries))
+        return [f'{answers[query]():.6E}' for query in queries]
+
     def get_driver_model(self):
         config = []
-        config.append({'element':'variable','name':'power','type':float,'read':self.get_power,'unit':'W'})
-        config.append({'element':'variable','name':'wavelength','type':float,'read':self.get_wavelength,'unit':'nm'})
+        config.append({'element':'variable','name':'power','type':float,'read':self.get_power,'unit':'W','query':'POW?'})
+        config.append({'element':'variable','name':'wavelength','type':float,'read':self.get_wavelength,'unit':'nm','query':'WAV?'})
         return config
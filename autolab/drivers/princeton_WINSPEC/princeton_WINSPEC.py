@@ -225,26 +225,24 @@ class Driver():
 ############################## Connections classes ##############################
 class Driver_SOCKET(Driver) :
     
-    def __init__(self,address='192.168.0.8',**kwargs):
+    def __init__(self,address='192.168.0.8',timeout=10,retries=3,**kwargs):
         
-        import socket 
+        from autolab.core.transport import get_transport
         
         self.ADDRESS = address
         self.PORT = 5005
         self.BUFFER_SIZE = 40000
         
-        self.controller = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.controller.connect((self.ADDRESS,int(self.PORT)))   
+        # Shared connection, reconnected if the link is broken
+        self.controller = get_transport(self.ADDRESS,self.PORT,timeout=timeout,retries=retries)
         
         Driver.__init__(self)
         
     def write(self,command):
-        self.controller.send(command.encode())
-        self.controller.recv(self.BUFFER_SIZE)
+        self.controller.query(command.encode(),None,self.BUFFER_SIZE)
         
     def query(self,command):
-        self.controller.send(command.encode())
-        data = self.controller.recv(self.BUFFER_SIZE)
+        data = self.controller.query(command.encode(),None,self.BUFFER_SIZE)
         return data.decode()
         
     def close(self):
@@ -55,37 +55,36 @@ class Driver():
 #################################################################################
 ############################## Connections classes ##############################
 class Driver_SOCKET(Driver):
-    def __init__(self, address='192.168.0.9', port=10001, **kwargs):
-        import socket
+    def __init__(self, address='192.168.0.9', port=10001, timeout=10, retries=3, **kwargs):
+        from autolab.core.transport import get_transport
         
-        self.sock=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((address, int(port)))
-        self.write('OPEN "anonymous"')
-        ans = self.read(1024)
+        # Shared connection, reconnected (and authenticated again) if the link is broken
+        self.transport = get_transport(address,port,timeout=timeout,retries=retries,on_connect=self.authenticate)
+        
+        Driver.__init__(self)
+
+    def authenticate(self,transport):
+        transport.write(b'OPEN "anonymous"\n')
+        ans = transport.read_until(b'\r\n',1024).decode().strip('\r\n')
         if not ans=='AUTHENTICATE CRAM-MD5.':
             print("problem with authentication")
-        self.write(" ")
-        ans = self.read(1024)
+        transport.write(b" \n")
+        ans = transport.read_until(b'\r\n',1024).decode().strip('\r\n')
         if not ans=='ready':
             print("problem with authentication")
-        
-        Driver.__init__(self)
 
     def write(self, msg):
         msg=(msg+"\n").encode()
-        self.sock.send(msg)
+        self.transport.write(msg)
     def read(self, length=100000):
-        msg=''
-        while not msg.endswith('\r\n'):
-            msg=msg+self.sock.recv(length).decode()
-        msg = msg[:-2]
-        return msg.strip('\r\n')
+        msg = self.transport.read_until(b'\r\n',length).decode()
+        return msg[:-2].strip('\r\n')
     def query(self,msg,length=100000):
         """Sends question and returns answer"""
-        self.write(msg)
-        return(self.read(length))
+        msg = self.transport.query((msg+"\n").encode(),b'\r\n',length).decode()
+        return msg[:-2].strip('\r\n')
     def close(self):
-        self.sock.close()
+        self.transport.close()
 ############################## Connections classes ##############################
 #################################################################################
 
@@ -4,14 +4,30 @@ Created on Fri Nov 22 21:03:46 2019
 
 @author: qchat
 """
-from threading import Thread, Event
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
 from autolab.core import elements
+from autolab.core.control import ScanControl
 import collections
-import itertools
+import hashlib
+import json
 import os
 import time
 import h5py
 
+# Orders available to visit the points of a multidimensional scan
+ORDERS = ['raster','serpentine','hilbert']
+
+# Maximum number of points in one chunk of the HDF5 datasets
+CHUNK_SIZE = 1024
+
+# HDF5 types of the datasets of scalar Variables
+SCALAR_DTYPES = {int:'i8',
+                 float:'f8',
+                 bool:'?',
+                 str:h5py.string_dtype(),
+                 bytes:h5py.vlen_dtype('uint8')}
+
 class Scanner :
     
     def __init__(self):
@@ -24,6 +40,15 @@ class Scanner :
         self._name = 'scan'
         self._datapath = os.path.realpath('./')
         
+        self._flush_rows = 100
+        self._flush_interval = 5
+        self._compression = None
+        self._compression_opts = None
+        self._order = 'raster'
+        self._hooks = []
+        self._profiling = False
+        self._profiler = None
+        
         self._thread = None
         self.verbose = False
         
@@ -42,7 +67,17 @@ class Scanner :
             
     
     def _check_modif_allowed(self):
-        assert self._thread is None, f"Scan is running, stop it first to modify it."
+        assert self._is_running() is False, f"Scan is running, stop it first to modify it."
+        
+        
+    def _is_running(self):
+        
+        ''' Returns True if a scan thread is running. A thread which has 
+        finished (for instance after an error of an instrument) is forgotten '''
+        
+        if self._thread is not None and not self._thread.is_alive() : 
+            self._thread = None
+        return self._thread is not None
 
             
     def clear(self):
@@ -86,6 +121,33 @@ class Scanner :
         return self._name
 
 
+
+    # Datafile writing
+    # =========================================================================
+    
+    def set_flush_policy(self,rows=100,interval=5):
+        
+        ''' Configure how often the buffered data are written in the datafile:
+        every <rows> points, or every <interval> seconds, whichever comes first '''
+        
+        self._check_modif_allowed()
+        assert int(rows) >= 1, "The number of rows between two flushes must be at least 1."
+        assert float(interval) >= 0, "The flush interval must be positive."
+        self._flush_rows = int(rows)
+        self._flush_interval = float(interval)
+        
+        
+    def set_compression(self,compression='gzip',level=None):
+        
+        ''' Enable the compression of the datasets of the datafile 
+        ('gzip', 'lzf' or None to disable it). <level> is the gzip level (0-9) '''
+        
+        self._check_modif_allowed()
+        assert compression in [None,'gzip','lzf'], "Compression must be 'gzip', 'lzf' or None."
+        self._compression = compression
+        self._compression_opts = level if compression == 'gzip' else None
+
+
         
     # Parameters and recipe
     # =========================================================================
@@ -123,6 +185,88 @@ class Scanner :
     
     
     
+    # Scan order
+    # =========================================================================
+    
+    def set_order(self,order):
+        
+        ''' Set the order in which the points of a multidimensional scan are 
+        visited:
+            - 'raster' : the last parameter is always swept in the same direction
+            - 'serpentine' : the sweep direction of each parameter is reversed 
+            every time an outer parameter changes (boustrophedon)
+            - 'hilbert' : generalized Hilbert curve (2 parameters only)
+            - 'auto' : the order with the lowest estimated move time, using the
+            move_time and settle_time of each Parameter '''
+        
+        self._check_modif_allowed()
+        assert order in ORDERS+['auto'], f"Order must be one of {ORDERS+['auto']}."
+        self._order = order
+        
+        
+    def get_order(self):
+        return self._order
+    
+    
+    def estimate_move_time(self,order=None):
+        
+        ''' Returns the estimated time spent to change the parameters values 
+        during the whole scan, for the given order (current order by default) '''
+        
+        if order is None : order = self._order
+        if order == 'auto' : order = ParameterSpace.best_order(self._parameters)
+        return ParameterSpace(self._parameters,order).estimate_move_time()
+    
+    
+    
+    
+    
+    # Step timing hooks
+    # =========================================================================
+    
+    def add_step_hook(self,callback):
+        
+        ''' Register a function called as callback(event, name, duration) at 
+        the start (event 'started', duration None) and at the end (event 
+        'finished', duration in seconds) of each parameter change and of each
+        recipe step '''
+        
+        self._check_modif_allowed()
+        self._hooks.append(callback)
+        
+        
+    def clear_step_hooks(self):
+        self._check_modif_allowed()
+        self._hooks = []
+    
+    
+    
+    
+    
+    # Profiling
+    # =========================================================================
+    
+    def set_profiling(self,state=True):
+        
+        ''' Enable or disable the recording of the wall time and of the driver 
+        call time of each parameter change and of each recipe step. The timings 
+        are saved per point in the group "profile" of the datafile '''
+        
+        self._check_modif_allowed()
+        self._profiling = bool(state)
+        
+        
+    def show_profile(self):
+        
+        ''' Prints the summary of the timings of the last profiled scan '''
+        
+        assert self._profiler is not None, "No profiled scan. Enable it with set_profiling(True) before starting the scan."
+        print(self._profiler)
+        
+        
+        
+    
+    
     # Structure
     # =========================================================================
     
@@ -146,6 +290,7 @@ class Scanner :
         if len(self._parameters) == 0 : print("No parameters\n"+'='*len('No parameters'))
         else : 
             print('Parameters:\n'+'='*len('Parameters:'))
+            if len(self._parameters) > 1 : print(f' Order: {self._order}')
             for name in self._parameters.keys() :
                 print("   "*indent+f' - {name}: {self._parameters[name].info()}')
                 indent += 1
@@ -183,7 +328,7 @@ class Scanner :
         
         ''' Start a new scan '''
         
-        assert self._thread is None, f'The scan is already running'
+        assert self._is_running() is False, f'The scan is already running'
         self._thread = ScanThread(self)
         self._thread.start()
         if self.verbose : print('Scan started')
@@ -195,7 +340,7 @@ class Scanner :
         ''' Stop the ongoing scan '''
         
         assert self._thread is not None, f'The scan is not running.'
-        self._thread.stop_event.set()
+        self._thread.control.stop()
         self._thread.join()
         self._thread = None
         if self.verbose : print('Scan stopped')
@@ -207,18 +352,27 @@ class Scanner :
         ''' Pause the ongoing scan '''
         
         assert self._thread is not None, f'The scan is not running.'
-        self._thread.pause_event.set()
+        self._thread.control.pause()
         print('Scan paused')
         
         
         
-    def resume(self):
+    def resume(self,datafile=None):
         
-        ''' Resume the ongoing scan '''
+        ''' Resume the ongoing scan. If the path of the datafile of an 
+        interrupted scan is provided, restart this scan from its first missing 
+        point (the scan configuration has to be the same) '''
         
-        assert self._thread is not None, f'The scan is not running.'
-        self._thread.pause_event.clear()
-        print('Scan resumed')
+        if datafile is None :
+            assert self._thread is not None, f'The scan is not running.'
+            self._thread.control.resume()
+            print('Scan resumed')
+            
+        else :
+            assert self._is_running() is False, f'The scan is already running'
+            self._thread = ScanThread(self,datafile)
+            self._thread.start()
+            if self.verbose : print(f'Scan resumed from point {self._thread.start_index}')
         
         
         
@@ -228,23 +382,52 @@ class Scanner :
         
 class ScanThread(Thread):
     
-    def __init__(self,scanner):
+    def __init__(self,scanner,datapath=None):
         
         self.scanner = scanner
         Thread.__init__(self)
         
-        # Itertools product on parameters
-        self.param_sets = list(dict(zip(self.scanner._parameters.keys(),x)) for x in itertools.product(*[a.values for a in self.scanner._parameters.values()]) )
+        # Lazy grid of the parameters values
+        order = self.scanner._order
+        if order == 'auto' : order = ParameterSpace.best_order(self.scanner._parameters)
+        self.param_space = ParameterSpace(self.scanner._parameters,order)
+        self.start_index = 0
+        
+        # Adaptive parameter : values chosen during the scan, up to its budget
+        self.adaptive = any(isinstance(p,AdaptiveParameter) for p in self.scanner._parameters.values())
+        if self.adaptive :
+            assert len(self.scanner._parameters) == 1, "An adaptive parameter must be the only parameter of the scan."
+            parameter = list(self.scanner._parameters.values())[0]
+            assert parameter.measure in self.scanner._recipe.keys() and isinstance(self.scanner._recipe[parameter.measure],Measure), f"Adaptive parameter: '{parameter.measure}' is not a Measure step of the recipe."
+            assert self.scanner._recipe[parameter.measure].element.numerical, f"Adaptive parameter: the Measure step '{parameter.measure}' must be numerical."
+            self.nb_points = parameter.budget
+        else :
+            self.nb_points = len(self.param_space)
             
-        # Pause and stop events
-        self.stop_event = Event()
-        self.pause_event = Event()
+        # Pause and stop requests, step timing hooks
+        self.control = ScanControl()
+        for hook in self.scanner._hooks :
+            self.control.add_hook(hook)
         
         # Current data
         self.data = collections.OrderedDict()
         
+        # Timings of the steps of the current point
+        self.profiler = ScanProfiler() if self.scanner._profiling else None
+        self.scanner._profiler = self.profiler
+        self.timings = {}
+        
+        # Parallel execution of the recipe groups (one access at a time per device)
+        self.executor = None
+        nb_workers = 1
+        for recipe in [self.scanner._initrecipe,self.scanner._recipe,self.scanner._endrecipe] :
+            for keys in group_steps(recipe) :
+                nb_workers = max(nb_workers,len(keys))
+        self.nb_workers = nb_workers
+        
         # Prepare datafile
-        self.prepare_datafile()
+        if datapath is None : self.prepare_datafile()
+        else : self.open_datafile(datapath)
         
         
         
@@ -261,16 +444,111 @@ class ScanThread(Thread):
             suffix = f'_{count}'
         self.datapath = os.path.join(self.scanner._datapath,self.scanner._name+suffix+'.hdf5')
 
+        # Open the datafile, kept open during the whole scan
+        self.writer = DataWriter(self.datapath,
+                                 flush_rows=self.scanner._flush_rows,
+                                 flush_interval=self.scanner._flush_interval,
+                                 compression=self.scanner._compression,
+                                 compression_opts=self.scanner._compression_opts,
+                                 verbose=self.scanner.verbose)
+
         # Prepare structure
-        def configure(file,obj,data_length):
+        def configure(obj,data_length):
             for key in obj.keys(): 
                 if isinstance(obj[key],(Parameter,Measure)) :
-                    file.create_dataset(key, (data_length,))     
-        with h5py.File(self.datapath, "a") as file :
-            configure(file,self.scanner._initrecipe,1)
-            configure(file,self.scanner._parameters,len(self.param_sets))
-            configure(file,self.scanner._recipe,len(self.param_sets))
-            configure(file,self.scanner._endrecipe,1)
+                    self.writer.create_dataset(key, data_length, obj[key].element.type)
+        configure(self.scanner._initrecipe,1)
+        configure(self.scanner._parameters,self.nb_points)
+        configure(self.scanner._recipe,self.nb_points)
+        configure(self.scanner._endrecipe,1)
+        self.configure_profile()
+        
+        # Informations required to resume the scan
+        self.writer.file.attrs['parameters'] = self.get_parameters_description()
+        self.writer.file.attrs['recipe_fingerprint'] = self.get_recipe_fingerprint()
+        self.writer.file.attrs['completed'] = 0
+        
+        
+        
+    def open_datafile(self,datapath):
+        
+        ''' Open the datafile of an interrupted scan, check that it has been 
+        produced by the same scan configuration and prepare the scan to 
+        continue from its first missing point '''
+        
+        self.datapath = os.path.realpath(datapath)
+        assert os.path.exists(self.datapath), f"Datafile {self.datapath} not found."
+        assert self.adaptive is False, "A scan with an adaptive parameter cannot be resumed."
+        
+        self.writer = DataWriter(self.datapath,
+                                 flush_rows=self.scanner._flush_rows,
+                                 flush_interval=self.scanner._flush_interval,
+                                 compression=self.scanner._compression,
+                                 compression_opts=self.scanner._compression_opts,
+                                 verbose=self.scanner.verbose)
+        
+        try :
+            attrs = self.writer.file.attrs
+            assert 'completed' in attrs, "This datafile does not contain any resume information."
+            assert attrs['parameters'] == self.get_parameters_description(), "The parameters of the scan are different from the ones of the datafile."
+            assert attrs['recipe_fingerprint'] == self.get_recipe_fingerprint(), "The recipes of the scan are different from the ones of the datafile."
+            self.start_index = int(attrs['completed'])
+            assert self.start_index < len(self.param_space), "This scan is already completed."
+        except :
+            self.writer.close()
+            raise
+        
+        # Register the types of the datasets (not existing yet for arrays and DataFrames never measured)
+        for obj, data_length in [(self.scanner._initrecipe,1),
+                                 (self.scanner._parameters,self.nb_points),
+                                 (self.scanner._recipe,self.nb_points),
+                                 (self.scanner._endrecipe,1)] :
+            for key in obj.keys(): 
+                if isinstance(obj[key],(Parameter,Measure)) :
+                    self.writer.create_dataset(key, data_length, obj[key].element.type)
+        self.configure_profile()
+                    
+                    
+                    
+    def configure_profile(self):
+        
+        ''' Prepare the datasets of the timings of each parameter and step '''
+        
+        if self.profiler is not None :
+            for obj, data_length in [(self.scanner._initrecipe,1),
+                                     (self.scanner._parameters,self.nb_points),
+                                     (self.scanner._recipe,self.nb_points),
+                                     (self.scanner._endrecipe,1)] :
+                for key in obj.keys() :
+                    for timing in ['wall','driver'] :
+                        self.writer.create_dataset(f'profile/{key}/{timing}', data_length, float)
+                    
+                    
+                    
+    def get_parameters_description(self):
+        
+        ''' Returns a JSON description of the parameters of the scan and of 
+        their values, in the order of the scan '''
+        
+        import numpy as np
+        
+        description = {'order':self.param_space.order,'parameters':[]}
+        for name, values in zip(self.param_space.names,self.param_space.values) :
+            description['parameters'].append({'name':name,
+                                              'address':self.scanner._parameters[name].element.address(),
+                                              'values':np.asarray(values).tolist()})
+        return json.dumps(description,default=str)
+    
+    
+    
+    def get_recipe_fingerprint(self):
+        
+        ''' Returns a hash of the configuration of the init, main and end recipes '''
+        
+        description = []
+        for recipe in [self.scanner._initrecipe,self.scanner._recipe,self.scanner._endrecipe] :
+            description.append([[key,step.info(),getattr(step,'group',None)] for key, step in recipe.items()])
+        return hashlib.sha256(json.dumps(description,default=str).encode()).hexdigest()
 
 
 
@@ -278,19 +556,68 @@ class ScanThread(Thread):
         
         ''' Start the execution of the scan '''
         
-        # Init recipe
-        self.reset_data()
-        self.execute_recipe(self.scanner._initrecipe)
+        try :
+            
+            if self.nb_workers > 1 :
+                self.executor = ThreadPoolExecutor(max_workers=self.nb_workers)
+            
+            # Init recipe
+            self.reset_data()
+            self.execute_recipe(self.scanner._initrecipe)
+            self.writer.flush()
+            
+            # Main recipe of each set of parameter
+            self.reset_data()
+            if self.adaptive :
+                self.run_adaptive()
+            else :
+                for i in range(self.start_index,len(self.param_space)) :
+                    if self.control.is_stopped() : break
+                    self.set_parameters(i)
+                    self.execute_recipe(self.scanner._recipe,i)
+                    if self.control.is_stopped() is False :
+                        self.writer.set_checkpoint(i+1)
+                
+            # End recipe
+            self.writer.flush()
+            self.reset_data()
+            self.execute_recipe(self.scanner._endrecipe)
+            
+        finally :
+            
+            if self.executor is not None :
+                self.executor.shutdown()
+            
+            # Write remaining data on the disk and release the datafile
+            self.writer.close()
+        
+        
+        
+    def run_adaptive(self):
+        
+        ''' Main loop of a scan with an AdaptiveParameter: each new value of the
+        parameter is chosen from the results of the previous points. The data 
+        are recorded in the order of the measurements '''
         
-        # Main recipe of each set of parameter
-        self.reset_data()
-        for i in range(len(self.param_sets)) :
-            self.set_parameters(i)
+        parameter = list(self.scanner._parameters.values())[0]
+        values, results = [], []
+        
+        while self.control.is_stopped() is False :
+            value = parameter.propose(values,results)
+            if value is None : break
+            i = len(values)
+            self.set_parameters(i,(value,))
             self.execute_recipe(self.scanner._recipe,i)
-            
-        # End recipe
-        self.reset_data()
-        self.execute_recipe(self.scanner._endrecipe)
+            if self.control.is_stopped() is False :
+                values.append(value)
+                results.append(float(self.data[parameter.measure]))
+                self.writer.set_checkpoint(i+1)
+        
+        # Remove the unused points of the datasets
+        keys = [key for obj in [self.scanner._parameters,self.scanner._recipe] 
+                for key in obj.keys() if isinstance(obj[key],(Parameter,Measure))]
+        self.writer.flush()
+        self.writer.resize(keys,len(values))
         
         
         
@@ -299,67 +626,110 @@ class ScanThread(Thread):
         ''' Reset the self.data dictionnary '''
         
         self.data = collections.OrderedDict()
+        self.timings = {}
         
         
         
     def execute_recipe(self,recipe,i=0):
         
-        """ Execute the given recipe for the i-th time """
+        """ Execute the given recipe for the i-th time. Consecutive steps of 
+        the same group are executed concurrently """
         
-        for key in recipe.keys() :
+        for keys in group_steps(recipe) :
             
             # If the scan has not been stopped
-            if self.stop_event.is_set() is False :
+            if self.control.is_stopped() is False :
                 
-                # Execute step
-                step = recipe[key]
-                ans = step.execute()
-                if ans is not None :
-                    self.data[key] = ans
-                if self.scanner.verbose : print(key, step.info(), ans)
+                # Execute step(s)
+                if len(keys) == 1 :
+                    answers = [self.execute_step(keys[0],recipe[keys[0]])]
+                else :
+                    futures = [self.executor.submit(self.execute_step,key,recipe[key]) for key in keys]
+                    answers = [future.result() for future in futures]
+                    
+                # Record results in the recipe order
+                for key, ans in zip(keys,answers) :
+                    if ans is not None :
+                        self.data[key] = ans
+                    if self.scanner.verbose : print(key, recipe[key].info(), ans)
                 
                 # If scan is paused, wait for resume
-                while self.pause_event.is_set() :
-                    time.sleep(0.1)
+                self.control.wait_if_paused()
               
             # If the scan has been stopped
             else :
                 break
         
         # Save data
-        if self.stop_event.is_set() is False :
+        if self.control.is_stopped() is False :
             self.save_data(i)
         
         
         
-    def set_parameters(self,i):
+    def execute_step(self,key,step):
+        
+        """ Execute a recipe step, with an exclusive access to its device """
+        
+        answer = None
+        driver_duration = 0
+        with self.control.step(key) :
+            start = time.perf_counter()
+            if isinstance(step,Wait) :
+                self.control.sleep(step.delay)
+            elif hasattr(step,'element') :
+                with step.element._device()._io_lock :
+                    answer = step.execute()
+                    driver_duration = step.element.last_call_duration
+            else :
+                answer = step.execute()
+            if self.profiler is not None :
+                self.record_timing(key,time.perf_counter()-start,driver_duration)
+        return answer
+    
+    
+    
+    def record_timing(self,key,wall_duration,driver_duration):
+        
+        """ Record the timings of a step in the profiler and in the data of the 
+        current point """
+        
+        self.profiler.record(key,wall_duration,driver_duration)
+        self.timings[f'profile/{key}/wall'] = wall_duration
+        self.timings[f'profile/{key}/driver'] = driver_duration
+        
+        
+        
+    def set_parameters(self,i,param_set=None):
         
-        """ Apply the i-th set of parameters """
+        """ Apply the i-th set of parameters (or the provided one) """
         
-        param_set = self.param_sets[i]
+        if param_set is None : param_set = self.param_space[i]
+        self.timings = {}
         
-        for key in param_set.keys() :
+        for key, value in zip(self.param_space.names,param_set) :
             
             # If the scan has not been stopped
-            if self.stop_event.is_set() is False :
+            if self.control.is_stopped() is False :
                 
-                value = param_set[key]
                 if key not in self.data.keys() or value != self.data[key] : 
                     parameter = self.scanner._parameters[key]
-                    parameter.element(param_set[key])
+                    with self.control.step(key) :
+                        start = time.perf_counter()
+                        parameter.element(value)
+                        if self.profiler is not None :
+                            self.record_timing(key,time.perf_counter()-start,parameter.element.last_call_duration)
                     self.data[key] = value
                     if self.scanner.verbose : print(key, parameter.info(), value)
                     
                 # If scan is paused, wait for resume
-                while self.pause_event.is_set() :
-                    time.sleep(0.1)
+                self.control.wait_if_paused()
         
             # If the scan has been stopped
             else :
                 break
             
         # Save data
-        if self.stop_event.is_set() is False :
+        if self.control.is_stopped() is False :
             self.save_data(i)
         
         
@@ -367,13 +737,428 @@ class ScanThread(Thread):
     def save_data(self,i=0):
         
         """ Save in the whole content of the current self.data dictionnary 
-        in the hdf5 datafile """
+        in the hdf5 datafile (buffered, see DataWriter) """
+        
+        self.writer.write(i,self.data)
+        if self.profiler is not None :
+            self.writer.write(i,self.timings)
+            
+
+
+
+def group_steps(recipe):
+    
+    ''' Returns the list of the lists of the names of the recipe steps that can 
+    be executed together: consecutive steps with the same group (not None) '''
+    
+    blocks = []
+    previous_group = None
+    for key, step in recipe.items() :
+        group = getattr(step,'group',None)
+        if group is not None and group == previous_group :
+            blocks[-1].append(key)
+        else :
+            blocks.append([key])
+        previous_group = group
+    return blocks
+
+
+
+class ParameterSpace :
+    
+    ''' Lazy multidimensional grid of the values of the parameters of a scan.
+    The set of values of the i-th point is computed on demand from its flat 
+    index i, following the given order (see Scanner.set_order). In the raster 
+    order, the points come in the same order as itertools.product (the last 
+    parameter is the fastest one) '''
+    
+    def __init__(self,parameters,order='raster'):
+        
+        assert order in ORDERS, f"Order must be one of {ORDERS}."
+        self.parameters = list(parameters.values())
+        self.names = list(parameters.keys())
+        self.order = order
+        self.values = []
+        for parameter in parameters.values() :
+            values = parameter.values
+            if not (hasattr(values,'__getitem__') and hasattr(values,'__len__')) :
+                values = list(values)
+            self.values.append(values)
+        self.shape = tuple(len(values) for values in self.values)
+        
+        # Number of points between two consecutive values of each parameter
+        self._strides = []
+        stride = 1
+        for size in reversed(self.shape) :
+            self._strides.insert(0,stride)
+            stride *= size
+        self._length = stride
+        
+        # Hilbert curve : table of the indexes, computed at first use
+        if order == 'hilbert' :
+            assert len(self.shape) == 2, "The hilbert order is only available for 2 parameters."
+        self._table = None
+        
+        
+        
+    def __len__(self):
+        
+        ''' Returns the total number of points of the grid '''
+        
+        return self._length
+    
+    
+    
+    def indexes(self,i):
+        
+        ''' Returns the index of the value of each parameter for the point i '''
+        
+        if i < 0 : i += self._length
+        if not 0 <= i < self._length :
+            raise IndexError(f'Point {i} out of range (scan of {self._length} points).')
+        return self._indexes(i)
+    
+    
+    
+    def _indexes(self,i):
+        
+        ''' Returns the index of the value of each parameter for the point(s) i.
+        Works with an integer or with a numpy array of integers '''
+        
+        if self.order == 'hilbert' :
+            if self._table is None : self._table = hilbert_table(*self.shape)
+            return tuple(self._table[i,k] for k in range(2))
+        
+        indexes = []
+        for k, (stride, size) in enumerate(zip(self._strides,self.shape)) :
+            index = (i//stride)%size
+            if self.order == 'serpentine' and k > 0 :
+                # Reversed direction if the number of previous sweeps is odd
+                index = index + ((i//self._strides[k-1])%2)*(size-1-2*index)
+            indexes.append(index)
+        return tuple(indexes)
+    
+    
+    
+    def __getitem__(self,i):
+        
+        ''' Returns the tuple of the values of the parameters for the point i '''
+        
+        return tuple(values[j] for values, j in zip(self.values,self.indexes(i)))
+    
+    
+    
+    def iterate(self,start=0):
+        
+        ''' Iterates over the points of the grid, starting from the point <start> '''
         
-        with h5py.File(self.datapath, "a") as file :
-            for key in self.data.keys():
-                file[key][i] = self.data[key]
-        if self.scanner.verbose : print('Saving data')
+        for i in range(start,self._length) :
+            yield self[i]
+            
+            
             
+    def __iter__(self):
+        
+        return self.iterate()
+    
+    
+    
+    def estimate_move_time(self,block_size=1000000):
+        
+        ''' Returns the estimated time (s) spent to change the parameters 
+        values during the whole scan, using the move_time and settle_time of 
+        each Parameter. Computed by blocks of points to limit memory usage '''
+        
+        import numpy as np
+        
+        total = 0
+        for start in range(0,self._length,block_size) :
+            flat = np.arange(max(0,start-1),min(self._length,start+block_size))
+            for parameter, values, indexes in zip(self.parameters,self.values,self._indexes(flat)) :
+                total += parameter.get_move_time(values,indexes)
+        return float(total)
+    
+    
+    
+    @staticmethod
+    def best_order(parameters):
+        
+        ''' Returns the order with the lowest estimated move time '''
+        
+        orders = [order for order in ORDERS if order != 'hilbert' or len(parameters) == 2]
+        return min(orders,key=lambda order : ParameterSpace(parameters,order).estimate_move_time())
+    
+    
+    
+    
+def hilbert_table(width,height):
+    
+    ''' Returns an array (width*height, 2) of the successive indexes of a 
+    generalized Hilbert curve covering a grid of any size (each point is 
+    adjacent to the previous one, except one diagonal step when both sizes 
+    have different parities). Based on the "gilbert" algorithm of J. Cervený '''
+    
+    import numpy as np
+    
+    def sign(x) :
+        return (x > 0) - (x < 0)
+    
+    def generate(x, y, ax, ay, bx, by) :
+        w = abs(ax + ay)
+        h = abs(bx + by)
+        dax, day = sign(ax), sign(ay)
+        dbx, dby = sign(bx), sign(by)
+        if h == 1 :
+            for _ in range(w) :
+                yield x, y
+                x, y = x + dax, y + day
+            return
+        if w == 1 :
+            for _ in range(h) :
+                yield x, y
+                x, y = x + dbx, y + dby
+            return
+        ax2, ay2 = ax//2, ay//2
+        bx2, by2 = bx//2, by//2
+        w2 = abs(ax2 + ay2)
+        h2 = abs(bx2 + by2)
+        if 2*w > 3*h :
+            # Long case: split in two parts only
+            if w2 % 2 and w > 2 :
+                ax2, ay2 = ax2 + dax, ay2 + day
+            yield from generate(x, y, ax2, ay2, bx, by)
+            yield from generate(x+ax2, y+ay2, ax-ax2, ay-ay2, bx, by)
+        else :
+            # Standard case: one step up, one long horizontal, one step down
+            if h2 % 2 and h > 2 :
+                bx2, by2 = bx2 + dbx, by2 + dby
+            yield from generate(x, y, bx2, by2, ax2, ay2)
+            yield from generate(x+bx2, y+by2, ax, ay, bx-bx2, by-by2)
+            yield from generate(x+(ax-dax)+(bx2-dbx), y+(ay-day)+(by2-dby),
+                                -bx2, -by2, -(ax-ax2), -(ay-ay2))
+    
+    if width >= height : points = generate(0, 0, width, 0, 0, height)
+    else : points = generate(0, 0, 0, height, width, 0)
+    
+    table = np.empty((width*height,2),dtype=np.int64)
+    for i, point in enumerate(points) :
+        table[i] = point
+    return table
+    
+    
+    
+    
+    
+    
+    
+    
+    
+class DataWriter :
+    
+    ''' Persistent handle on the HDF5 datafile of a scan. Rows are buffered 
+    in memory and written by contiguous blocks in chunked, resizable datasets,
+    every <flush_rows> rows or every <flush_interval> seconds.
+    
+    The layout of a dataset depends on the type of the Variable it stores:
+        - int, float, bool : 1D dataset of scalars
+        - str, bytes : 1D dataset of variable-length strings / bytes
+        - np.ndarray : (N, *shape) dataset, one chunk per point
+        - pd.DataFrame : (N, nb_rows) compound dataset, one chunk per point
+    The arrays and DataFrames datasets are created at the first flush, when 
+    the shape of the data is known. It then has to remain the same during the 
+    whole scan. '''
+    
+    def __init__(self,path,flush_rows=100,flush_interval=5,compression=None,
+                 compression_opts=None,verbose=False):
+        
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.verbose = verbose
+        
+        self.file = h5py.File(path,'a')
+        
+        # Layouts {key: (length, type)} of the datasets not created yet
+        self._pending = {}
+        self._types = {}
+        
+        # Buffer {index: {key: value}}, merged when the same index is written twice
+        self._buffer = collections.OrderedDict()
+        self._last_flush = time.monotonic()
+        
+        # Number of completed points, stored in the datafile with the data
+        self._checkpoint = None
+        
+        
+        
+    def create_dataset(self,key,length,element_type=float):
+        
+        ''' Declare a resizable dataset of initial size <length>, which layout 
+        depends on <element_type> '''
+        
+        import numpy as np
+        import pandas as pd
+        
+        self._types[key] = element_type
+        if key in self.file :
+            pass
+        elif element_type in [np.ndarray,pd.DataFrame] :
+            self._pending[key] = length
+        else :
+            self._create(key,(length,),SCALAR_DTYPES[element_type],
+                         (max(1,min(length,CHUNK_SIZE)),))
+            
+            
+            
+    def _create(self,key,shape,dtype,chunks):
+        
+        ''' Create a chunked dataset resizable along its first axis '''
+        
+        self.file.create_dataset(key,shape,dtype=dtype,chunks=chunks,
+                                 maxshape=(None,)+tuple(shape[1:]),
+                                 compression=self.compression,
+                                 compression_opts=self.compression_opts)
+        
+        
+        
+    def _create_pending(self,key,value):
+        
+        ''' Create a dataset of arrays or DataFrames using the shape of the 
+        first value received '''
+        
+        length = self._pending.pop(key)
+        value = self._convert(key,value)
+        self._create(key,(length,)+value.shape,value.dtype,(1,)+value.shape)
+        
+        
+        
+    def _convert(self,key,value):
+        
+        ''' Returns the value in a form that can be stored in the dataset <key> '''
+        
+        import numpy as np
+        import pandas as pd
+        
+        element_type = self._types.get(key,float)
+        if element_type == np.ndarray :
+            return np.asarray(value)
+        elif element_type == pd.DataFrame :
+            records = value.to_records(index=False)
+            dtype = [(name,h5py.string_dtype() if records.dtype[name].kind in 'OU' else records.dtype[name])
+                     for name in records.dtype.names]
+            return records.astype(dtype)
+        elif element_type == bytes :
+            return np.frombuffer(value,dtype=np.uint8)
+        else :
+            return value
+        
+        
+        
+    def resize(self,keys,length):
+        
+        ''' Resize the datasets <keys> to <length> points '''
+        
+        for key in keys :
+            if key in self._pending : self._pending[key] = length
+            else : self.file[key].resize(length,axis=0)
+            
+            
+            
+    def set_checkpoint(self,completed):
+        
+        ''' Declare that the <completed> first points of the scan are done. This
+        information is stored in the datafile at the next flush '''
+        
+        self._checkpoint = completed
+        
+        
+        
+    def write(self,i,data):
+        
+        ''' Buffer the values of the dictionnary <data> at the index i of the
+        datasets, and flush the buffer if necessary '''
+        
+        if i not in self._buffer : self._buffer[i] = {}
+        self._buffer[i].update(data)
+        
+        if len(self._buffer) >= self.flush_rows or time.monotonic()-self._last_flush >= self.flush_interval :
+            self.flush()
+            
+            
+            
+    def flush(self):
+        
+        ''' Write the buffered rows in the datafile '''
+        
+        import numpy as np
+        
+        # The rows and the checkpoint are removed from the buffer first: if the 
+        # rows cannot be written, they are dropped (not written again at the next 
+        # flush), and the datafile does not record them as completed
+        buffer, self._buffer = self._buffer, collections.OrderedDict()
+        checkpoint, self._checkpoint = self._checkpoint, None
+        
+        if len(buffer) > 0 :
+            
+            # Gather the buffered values per dataset
+            columns = collections.OrderedDict()
+            for i, row in buffer.items() :
+                for key, value in row.items() :
+                    if key not in columns : columns[key] = {}
+                    columns[key][i] = value
+            
+            # Write each contiguous block of indexes in one operation
+            for key, column in columns.items() :
+                indexes = sorted(column.keys())
+                if key in self._pending :
+                    self._create_pending(key,column[indexes[0]])
+                dataset = self.file[key]
+                if indexes[-1] >= dataset.shape[0] :
+                    dataset.resize(indexes[-1]+1,axis=0)
+                start = 0
+                for j in range(1,len(indexes)+1) :
+                    if j == len(indexes) or indexes[j] != indexes[j-1]+1 :
+                        block = indexes[start:j]
+                        values = [self._convert(key,column[k]) for k in block]
+                        if dataset.ndim > 1 :
+                            for value in values :
+                                assert value.shape == dataset.shape[1:], f"Dataset {key}: the shape of the data changed during the scan ({value.shape} instead of {dataset.shape[1:]})."
+                            values = np.stack(values)
+                        elif dataset.dtype == object and len(values) > 1 :
+                            array = np.empty(len(values),dtype=object)
+                            for k, value in enumerate(values) : array[k] = value
+                            values = array
+                        if dataset.dtype == object and len(values) == 1 :
+                            dataset[block[0]] = values[0]
+                        else :
+                            dataset[block[0]:block[-1]+1] = values
+                        start = j
+            
+            if self.verbose : print('Saving data')
+        
+        if checkpoint is not None :
+            self.file.attrs['completed'] = checkpoint
+        self.file.flush()
+        
+        self._last_flush = time.monotonic()
+        
+        
+        
+    def close(self):
+        
+        ''' Flush the remaining data, synchronize the datafile on the disk and
+        close it '''
+        
+        if self.file.id.valid :
+            try :
+                self.flush()
+            finally : # The datafile is released even if the last data cannot be written
+                try : os.fsync(self.file.id.get_vfd_handle())
+                except Exception : pass
+                self.file.close()
+        
         
         
         
@@ -390,20 +1175,193 @@ class ScanThread(Thread):
 # +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
         
         
+class ScanProfiler :
+    
+    ''' Records the wall time and the driver call time of each parameter 
+    change and each recipe step of a scan '''
+    
+    def __init__(self):
+        
+        # {name: [[wall durations], [driver durations]]}
+        self.records = collections.OrderedDict()
+        self._lock = Lock()
+        
+        
+        
+    def record(self,name,wall_duration,driver_duration):
+        
+        ''' Add the timings of one execution of the step <name> '''
+        
+        with self._lock :
+            if name not in self.records : self.records[name] = [[],[]]
+            self.records[name][0].append(wall_duration)
+            self.records[name][1].append(driver_duration)
+        
+        
+        
+    def summary(self):
+        
+        ''' Returns a dictionnary {name: statistics} with the number of calls and
+        the mean, median (p50), 99th percentile (p99) and total wall time of each 
+        step, and its total driver call time '''
+        
+        import numpy as np
+        
+        summary = collections.OrderedDict()
+        with self._lock :
+            for name, (wall, driver) in self.records.items() :
+                wall = np.asarray(wall)
+                summary[name] = {'count':len(wall),
+                                 'mean':float(wall.mean()),
+                                 'p50':float(np.percentile(wall,50)),
+                                 'p99':float(np.percentile(wall,99)),
+                                 'total':float(wall.sum()),
+                                 'driver':float(np.sum(driver))}
+        return summary
+    
+    
+    
+    def __str__(self):
+        
+        ''' Returns the summary as a table, sorted by total wall time '''
+        
+        summary = self.summary()
+        if len(summary) == 0 : return 'No timings recorded'
+        width = max(10,max(len(name) for name in summary.keys()))
+        header = f"{'Step':{width}s} {'Count':>8s} {'Mean (s)':>10s} {'p50 (s)':>10s} {'p99 (s)':>10s} {'Total (s)':>10s} {'Driver (s)':>10s}"
+        lines = [header,'='*len(header)]
+        for name, stats in sorted(summary.items(),key=lambda item : -item[1]['total']) :
+            lines.append(f"{name:{width}s} {stats['count']:8d} {stats['mean']:10.4g} {stats['p50']:10.4g} "
+                         f"{stats['p99']:10.4g} {stats['total']:10.4g} {stats['driver']:10.4g}")
+        return '\n'.join(lines)
+    
+    
+    
+    
+    
+    
+    
+    
+    
 class Parameter:
     
     ''' Class dedicated to parameter declaration '''
     
-    def __init__(self,element,values):
+    def __init__(self,element,values,move_time=0,settle_time=0):
         assert isinstance(element,elements.Variable), "A parameter must be a Variable"
         assert element.writable is True, f"SET step: Variable {element.address()} is not writable."
         self.element = element
         assert hasattr(values, '__iter__'), "Parameter values must be iterable"
         self.values = values  
         
+        # Cost model of a change of value: settle_time + move_time * |new-old| (seconds)
+        try : 
+            move_time = float(move_time)
+            settle_time = float(settle_time)
+        except : raise ValueError('Parameter move_time and settle_time must be numerical.')
+        self.move_time = move_time
+        self.settle_time = settle_time
+        
     def info(self):
         return f"Sweep parameter {self.element.address()} with {len(self.values)} values."
         
+    def get_move_time(self,values,indexes):
+        
+        ''' Returns the estimated time (s) to set successively the values of 
+        values[indexes] (numpy array of indexes) : settle_time for each change of 
+        value, plus move_time * |new-old| if the values are numerical '''
+        
+        import numpy as np
+        
+        try : values = np.asarray(values,dtype=float)
+        except (TypeError,ValueError) : values = None
+        if values is None or values.ndim != 1 : # Non numerical values: only the changes are counted
+            return self.settle_time*np.count_nonzero(np.diff(indexes))
+        steps = np.abs(np.diff(values[indexes]))
+        return self.settle_time*np.count_nonzero(steps) + self.move_time*steps.sum()
+        
+        
+        
+        
+class AdaptiveParameter(Parameter):
+    
+    ''' Parameter which values are chosen during the scan. The parameter is 
+    first swept over a coarse grid of <initial_points> values between <start> 
+    and <stop>. Then, new points are inserted one by one in the middle of the 
+    interval where the result of the Measure step <measure> changes the most, 
+    until <budget> points have been measured or until the refinement score of 
+    every interval is below <tolerance>. 
+    
+    Criterion 'gradient' : score = length of the interval in the (x,y) plane
+    Criterion 'curvature' : score = width of the interval weighted by the
+    change of slope at its boundaries 
+    (x and y being normalized by the span of the parameter and of the results) '''
+    
+    def __init__(self,element,start,stop,measure,budget=100,initial_points=10,
+                 tolerance=0,criterion='curvature',min_step=None,move_time=0,settle_time=0):
+        
+        import numpy as np
+        
+        assert element.numerical is True, "An adaptive parameter must be numerical."
+        assert int(initial_points) >= 3, "An adaptive parameter needs at least 3 initial points."
+        assert int(budget) >= int(initial_points), "The budget of an adaptive parameter must be larger than its number of initial points."
+        assert criterion in ['gradient','curvature'], "Criterion must be 'gradient' or 'curvature'."
+        
+        Parameter.__init__(self,element,np.linspace(float(start),float(stop),int(initial_points)),
+                           move_time=move_time,settle_time=settle_time)
+        self.start = float(start)
+        self.stop = float(stop)
+        self.measure = measure
+        self.budget = int(budget)
+        self.tolerance = float(tolerance)
+        self.criterion = criterion
+        if min_step is None : min_step = abs(self.stop-self.start)*1e-6
+        self.min_step = float(min_step)
+        
+    def info(self):
+        return f"Adaptive sweep of parameter {self.element.address()} from {self.start} to {self.stop}, up to {self.budget} points refined on '{self.measure}'."
+    
+    def get_scores(self,values,results):
+        
+        ''' Returns the sorted values and the refinement score of each interval 
+        between two consecutive sorted values '''
+        
+        import numpy as np
+        
+        order = np.argsort(values)
+        x = np.asarray(values,dtype=float)[order]
+        y = np.asarray(results,dtype=float)[order]
+        x_span = abs(self.stop-self.start) or 1.
+        y_span = (np.nanmax(y)-np.nanmin(y)) or 1.
+        dx = np.diff(x)/x_span
+        dy = np.diff(y)/y_span
+        
+        if self.criterion == 'gradient' :
+            scores = np.hypot(dx,dy)
+        else :
+            slopes = dy/np.where(dx > 0,dx,np.inf)
+            curvature = np.zeros(len(x))
+            curvature[1:-1] = np.abs(np.diff(slopes))
+            scores = dx*np.sqrt(1+np.maximum(curvature[:-1],curvature[1:])**2)
+            
+        # Intervals too small to be split
+        scores[np.diff(x) < 2*self.min_step] = 0
+        return x, np.nan_to_num(scores)
+        
+    def propose(self,values,results):
+        
+        ''' Returns the next value of the parameter to measure, given the 
+        previous values and their results, or None if the refinement is done '''
+        
+        if len(values) < len(self.values) : return self.values[len(values)]
+        if len(values) >= self.budget : return None
+        
+        x, scores = self.get_scores(values,results)
+        k = int(scores.argmax())
+        if scores[k] <= self.tolerance : return None
+        return (x[k]+x[k+1])/2
+        
+        
         
         
         
@@ -411,9 +1369,10 @@ class Execute:
     
     ''' Scan step dedicated to execute an Action '''
     
-    def __init__(self,element,value=None):
+    def __init__(self,element,value=None,group=None):
         assert isinstance(element,elements.Action), "EXECUTE step element must be an Action."
         self.element = element
+        self.group = group
         self.value = None
         if value is not None :
             assert element.has_parameter is True, f"EXECUTE step: element {element.address()} has no parameter."
@@ -438,10 +1397,11 @@ class Set:
     
     ''' Scan step dedicated to set the value of a Variable '''
     
-    def __init__(self,element,value):
+    def __init__(self,element,value,group=None):
         assert isinstance(element,elements.Variable), "SET step element must be a Variable."
         assert element.writable is True, f"SET step: Variable {element.address()} is not writable."
         self.element = element
+        self.group = group
         try : value = element.type(value)
         except : raise ValueError(f'SET step: value must be of type {element.type}.')
         self.value = value
@@ -460,10 +1420,11 @@ class Measure:
     
     ''' Scan step dedicated to measure a Variable '''
 
-    def __init__(self,element):
+    def __init__(self,element,group=None):
         assert isinstance(element,elements.Variable), "MEASURE step element must be a Variable."
         assert element.readable is True, f"MEASURE step: Variable {element.address()} is not readable."
         self.element = element
+        self.group = group
         
     def info(self):
         return f'Measure variable {self.element.address()}.'
@@ -485,7 +1446,7 @@ class Wait:
         self.delay = delay
         
     def info(self):
-        return f'Wait {self.value} seconds.'
+        return f'Wait {self.delay} seconds.'
         
     def execute(self):
         time.sleep(self.delay)
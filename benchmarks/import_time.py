@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the time needed to import autolab
+
+Each run imports autolab in a fresh interpreter with python -X importtime, and
+reports the total import time as well as the slowest modules (cumulative time).
+
+Usage : python benchmarks/import_time.py [nb_runs] [nb_modules]
+"""
+
+import os
+import sys
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times():
+
+    ''' Imports autolab in a new interpreter and returns {module: cumulative time (s)} '''
+
+    code = f'import sys; sys.path.insert(0,{ROOT!r}); import autolab'
+    process = subprocess.run([sys.executable,'-X','importtime','-c',code],
+                             stderr=subprocess.PIPE,stdout=subprocess.DEVNULL,
+                             universal_newlines=True,check=True)
+
+    times = {}
+    for line in process.stderr.splitlines() :
+        if not line.startswith('import time:') or 'self [us]' in line : continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)*1e-6
+    return times
+
+
+def main():
+
+    nbruns = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    nbmodules = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+
+    runs = [import_times() for i in range(nbruns)]
+    totals = [run['autolab'] for run in runs]
+    print(f'import autolab: median {statistics.median(totals)*1e3:.1f} ms, '
+          f'min {min(totals)*1e3:.1f} ms, max {max(totals)*1e3:.1f} ms ({nbruns} runs)\n')
+
+    print('Slowest modules (median cumulative time):')
+    medians = {name:statistics.median([run.get(name,0) for run in runs]) for name in runs[0]}
+    for name in sorted(medians,key=medians.get,reverse=True)[:nbmodules] :
+        print(f'    {medians[name]*1e3:8.1f} ms  {name}')
+
+
+if __name__ == '__main__' :
+    main()
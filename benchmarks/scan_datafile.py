@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the HDF5 datafile writing of autolab.scan.ScanThread
+
+Compares the number of points per second that can be saved:
+    - legacy : the datafile is opened and closed twice per point
+    - buffered : persistent handle with the DataWriter of autolab.scan
+
+Usage : python benchmarks/scan_datafile.py [nb_points] [nb_datasets]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import h5py
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from autolab.scan import DataWriter
+
+
+def legacy(path,nbpts,keys):
+
+    ''' Reproduces the previous behaviour: two open/close of the datafile per point '''
+
+    with h5py.File(path,'a') as file :
+        for key in keys : file.create_dataset(key,(nbpts,),dtype='f')
+
+    for i in range(nbpts) :
+        for part in (keys[:1],keys[1:]) :
+            with h5py.File(path,'a') as file :
+                for key in part : file[key][i] = float(i)
+
+
+def buffered(path,nbpts,keys):
+
+    ''' Same data written through the DataWriter '''
+
+    writer = DataWriter(path)
+    for key in keys : writer.create_dataset(key,nbpts)
+    for i in range(nbpts) :
+        writer.write(i,{keys[0]:float(i)})
+        writer.write(i,{key:float(i) for key in keys[1:]})
+    writer.close()
+
+
+def main():
+
+    nbpts = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    nbkeys = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    keys = [f'data{k}' for k in range(nbkeys)]
+
+    import pandas # Imported by DataWriter.create_dataset: excluded from the timings
+
+    with tempfile.TemporaryDirectory() as folder :
+        for name, function in [('legacy',legacy),('buffered',buffered)] :
+            path = os.path.join(folder,f'{name}.hdf5')
+            t0 = time.perf_counter()
+            function(path,nbpts,keys)
+            duration = time.perf_counter()-t0
+            print(f'{name:10s}: {nbpts/duration:12.0f} points/s ({nbpts} points, {nbkeys} datasets, {duration:.3f} s)')
+
+
+if __name__ == '__main__' :
+    main()